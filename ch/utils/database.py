@@ -1,4 +1,5 @@
-import os, sys
+import os, sys, glob, shutil, hashlib
+import multiprocessing as mp
 
 import ch.utils.logger as log
 
@@ -21,4 +22,288 @@ def duckdb_connect(db_file, read_only=False):
 
     log.logit(f"Connecting to existing duckdb file: {db_file}")
     connection = duckdb.connect(db_file, read_only=read_only)
+    configure_connection(connection)
+    create_vkey_macros(connection)
     return connection
+
+# Every DuckDB connection gets its memory_limit, threads, temp_directory and preserve_insertion_order from one budget.
+# The budget defaults to what the cgroup (or else the machine) allows this process, can be set through the CLI or the
+# CH_TOOLKIT_MEMORY_LIMIT, CH_TOOLKIT_THREADS and CH_TOOLKIT_TEMP_DIRECTORY environment variables, and is split evenly
+# between the workers of a worker_pool, so N workers together never claim more than one process would
+budget = {
+    'memory_limit'             : os.environ.get('CH_TOOLKIT_MEMORY_LIMIT'),
+    'threads'                  : os.environ.get('CH_TOOLKIT_THREADS'),
+    'temp_directory'           : os.environ.get('CH_TOOLKIT_TEMP_DIRECTORY'),
+    'preserve_insertion_order' : True,
+    'workers'                  : 1
+}
+MEMORY_FRACTION = 0.8
+
+def read_cgroup(path):
+    try:
+        with open(path) as f:
+            return f.read().split()
+    except (OSError, ValueError):
+        return None
+
+def available_memory():
+    limits = []
+    for path in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        value = read_cgroup(path)
+        if value and value[0].isdigit():
+            limits.append(int(value[0]))
+    limits.append(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+    return min(limits)
+
+def available_threads():
+    threads = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    quota = read_cgroup('/sys/fs/cgroup/cpu.max')
+    if quota and quota[0].isdigit():
+        threads = min(threads, max(1, int(quota[0]) // int(quota[1])))
+    return threads
+
+def parse_memory(memory):
+    units = {'KB': 1 << 10, 'MB': 1 << 20, 'GB': 1 << 30, 'TB': 1 << 40}
+    memory = str(memory).strip().upper().replace('IB', 'B')
+    for unit, size in units.items():
+        if memory.endswith(unit):
+            return int(float(memory[:-len(unit)]) * size)
+    return int(memory)
+
+def set_budget(memory_limit=None, threads=None, temp_directory=None, preserve_insertion_order=None):
+    if memory_limit is not None: budget['memory_limit'] = memory_limit
+    if threads is not None: budget['threads'] = threads
+    if temp_directory is not None: budget['temp_directory'] = temp_directory
+    if preserve_insertion_order is not None: budget['preserve_insertion_order'] = preserve_insertion_order
+
+def connection_settings():
+    workers = budget['workers']
+    memory = parse_memory(budget['memory_limit']) if budget['memory_limit'] else int(available_memory() * MEMORY_FRACTION)
+    threads = int(budget['threads']) if budget['threads'] else available_threads()
+    settings = {
+        'memory_limit'             : f"{max(memory // workers, 1 << 28) >> 20}MB",
+        'threads'                  : max(threads // workers, 1),
+        'preserve_insertion_order' : budget['preserve_insertion_order']
+    }
+    # Each process spills into its own folder, DuckDB does not expect to share one
+    if budget['temp_directory']:
+        settings['temp_directory'] = os.path.join(budget['temp_directory'], f"ch-toolkit.{os.getpid()}")
+    return settings
+
+def configure_connection(connection):
+    for setting, value in connection_settings().items():
+        connection.execute(f"SET {setting} = '{value}'")
+    return connection
+
+def share_budget(workers, parent_budget):
+    budget.update(parent_budget)
+    budget['workers'] = workers
+
+# A multiprocessing Pool whose workers each get 1/cores of the budget for their connections
+def worker_pool(cores):
+    return mp.Pool(cores, initializer=share_budget, initargs=(cores, dict(budget)))
+
+# The variant key chrom:pos:ref:alt packed into a BIGINT, used for joins and lookups instead of the VARCHAR key
+#   bits 58-62: contig, 1-22 for chr1-chr22, 23 chrX, 24 chrY, 25 chrM and 0 for any other contig, so vkey_in_chrom only
+#               ever matches the listed contigs (see chrom_filter for the others)
+#   bits 29-57: position
+#   bits 0-28:  alleles, 1-16 for single base substitutions and 32 + md5(chrom:ref:alt) for everything else
+# Only the hashed alleles can collide, which is checked for whenever variants are merged (see variants.py).
+# The string key is kept in the variants table, so it can always be recovered by joining on vkey
+CONTIGS = ['chr1', 'chr2', 'chr3', 'chr4', 'chr5', 'chr6', 'chr7', 'chr8', 'chr9', 'chr10',
+           'chr11', 'chr12', 'chr13', 'chr14', 'chr15', 'chr16', 'chr17', 'chr18', 'chr19', 'chr20',
+           'chr21', 'chr22', 'chrX', 'chrY', 'chrM']
+VKEY_HASHED = 32
+
+def create_vkey_macros(connection):
+    contigs = ', '.join([f"'{contig}'" for contig in CONTIGS])
+    sql = f"""
+        CREATE OR REPLACE TEMP MACRO vkey_contig(chrom) AS coalesce(list_position([{contigs}], chrom), 0);
+        CREATE OR REPLACE TEMP MACRO vkey(chrom, pos, ref, alt) AS
+            (vkey_contig(chrom)::BIGINT << 58) | (pos::BIGINT << 29) |
+            CASE WHEN vkey_contig(chrom) > 0 AND ref IN ('A', 'C', 'G', 'T') AND alt IN ('A', 'C', 'G', 'T')
+                THEN list_position(['A', 'C', 'G', 'T'], ref) * 4 + list_position(['A', 'C', 'G', 'T'], alt) - 4
+                ELSE {VKEY_HASHED} + (md5_number_lower(chrom || ':' || ref || ':' || alt) % {(1 << 29) - VKEY_HASHED})::BIGINT
+            END;
+        CREATE OR REPLACE TEMP MACRO vkey_of(key) AS
+            vkey(split_part(key, ':', 1), split_part(key, ':', 2)::BIGINT, split_part(key, ':', 3), split_part(key, ':', 4));
+        CREATE OR REPLACE TEMP MACRO vkey_hashed(vkey) AS (vkey & {(1 << 29) - 1}) >= {VKEY_HASHED};
+        CREATE OR REPLACE TEMP MACRO vkey_in_chrom(vkey, chrom) AS
+            vkey_contig(chrom) > 0 AND vkey BETWEEN vkey_contig(chrom)::BIGINT << 58 AND ((vkey_contig(chrom)::BIGINT + 1) << 58) - 1;
+        CREATE OR REPLACE TEMP MACRO vkey_chrom(vkey) AS coalesce(list_extract([{contigs}], (vkey >> 58)::INTEGER), 'other');
+    """
+    connection.execute(sql)
+
+# Every per-sample database merged into a batch database is recorded in its merge_manifest table, in the same
+# transaction as its rows. A rerun after a failure, or with files added to the batch, only merges the files that are not
+# in the manifest yet or have changed since (a different size or mtime, and then a different checksum)
+def ensure_merge_manifest(connection):
+    sql = """
+        CREATE TABLE IF NOT EXISTS merge_manifest(
+            file                   VARCHAR NOT NULL,
+            size                   BIGINT,
+            mtime                  DOUBLE,
+            checksum               VARCHAR,
+            rows                   BIGINT,
+            batch                  INTEGER,
+            merged_at              TIMESTAMP
+        )
+    """
+    connection.execute(sql)
+
+def file_checksum(file):
+    checksum = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+def file_signature(file, rows):
+    stat = os.stat(file)
+    return {'file': os.path.abspath(file), 'size': stat.st_size, 'mtime': stat.st_mtime, 'checksum': file_checksum(file), 'rows': rows}
+
+def unmerged_files(connection, files):
+    manifest = connection.execute("SELECT file, size, mtime, checksum FROM merge_manifest").fetchall()
+    merged = {file: (size, mtime, checksum) for file, size, mtime, checksum in manifest}
+    pending = []
+    for file in files:
+        if os.path.abspath(file) in merged:
+            size, mtime, checksum = merged[os.path.abspath(file)]
+            stat = os.stat(file)
+            if (stat.st_size, stat.st_mtime) == (size, mtime) or file_checksum(file) == checksum:
+                continue
+        pending.append(file)
+    if len(files) > len(pending):
+        log.logit(f"Skipping {len(files) - len(pending)} files that are already merged")
+    return pending
+
+def record_merged_files(connection, signatures, batch_number):
+    files = [signature['file'] for signature in signatures]
+    connection.execute("DELETE FROM merge_manifest WHERE list_contains(?, file)", [files])
+    for signature in signatures:
+        connection.execute("INSERT INTO merge_manifest VALUES (?, ?, ?, ?, ?, ?, current_timestamp)",
+                           [signature['file'], signature['size'], signature['mtime'], signature['checksum'], signature['rows'], batch_number])
+
+# Instead of a DuckDB file, the tables of a database can be kept as a Parquet dataset: a directory with one folder per
+# table, hive partitioned by chromosome and batch (e.g. mutect.dataset/mutect/partition_chrom=chr1/partition_batch=2/).
+# The partition columns only exist in the folder names, so the rows read back are exactly the rows of the table, and any
+# filter on them is answered by reading only the matching folders
+DATASET_TABLES = {
+    'mutect'     : ['mutect'],
+    'vardict'    : ['vardict'],
+    'variant'    : ['variants'],
+    'pileup'     : ['pileup'],
+    'annotation' : ['vep', 'pd']
+}
+DATASET_OPTIONS = "FORMAT 'parquet', COMPRESSION 'zstd', ROW_GROUP_SIZE 122880"
+
+def is_dataset(path):
+    return os.path.isdir(path)
+
+def dataset_scan(dataset, table, chrom=None, batch=None):
+    folder = f"{dataset}/{table}"
+    has_batch = len(glob.glob(f"{folder}/*/partition_batch=*")) > 0
+    hive_types = "{'partition_chrom': VARCHAR, 'partition_batch': INTEGER}" if has_batch else "{'partition_chrom': VARCHAR}"
+    where = ["TRUE"]
+    if chrom is not None: where.append(f"partition_chrom = '{chrom}'")
+    if batch is not None and has_batch: where.append(f"partition_batch = {batch}")
+    return f"""
+        SELECT * EXCLUDE ({'partition_chrom, partition_batch' if has_batch else 'partition_chrom'})
+        FROM read_parquet('{folder}/**/*.parquet', hive_partitioning = true, hive_types = {hive_types})
+        WHERE {' AND '.join(where)}
+    """
+
+# ATTACH either a DuckDB file or a Parquet dataset under alias, so {alias}.{table} reads the same in both cases.
+# A dataset is attached as views over its partitions, restricted to chrom and batch when they are given.
+# Read-only attaches cannot be migrated, so a DuckDB file with tables from before vkey existed (see legacy_tables) is
+# attached as views that compute vkey from the key, like the migrations run when the file is opened for writing
+def duckdb_attach(connection, path, alias, chrom=None, batch=None):
+    if not is_dataset(path):
+        connection.execute(f"ATTACH '{path}' as {alias} (READ_ONLY)")
+        legacy = legacy_tables(connection, alias)
+        if not legacy:
+            return
+        log.logit(f"{path} has tables without vkey: {', '.join(legacy)}, computing it from their key")
+        tables = connection.execute(f"SELECT table_name FROM duckdb_tables() WHERE database_name = '{alias}'").fetchall()
+        connection.execute(f"DETACH {alias}")
+        connection.execute(f"ATTACH '{path}' as {alias}_file (READ_ONLY)")
+        connection.execute(f"ATTACH ':memory:' as {alias}")
+        for (table,) in tables:
+            columns = legacy_columns(table) if table in legacy else "*"
+            connection.execute(f"CREATE VIEW {alias}.{table} AS SELECT {columns} FROM {alias}_file.{table}")
+        return
+    connection.execute(f"ATTACH ':memory:' as {alias}")
+    for table in sorted(os.listdir(path)):
+        connection.execute(f"CREATE VIEW {alias}.{table} AS {dataset_scan(path, table, chrom, batch)}")
+
+def duckdb_detach(connection, alias):
+    connection.execute(f"DETACH {alias}")
+    connection.execute(f"DETACH DATABASE IF EXISTS {alias}_file")
+
+# The filter on the rows of chrom, a vkey range for the listed CONTIGS and a match on the key for any other contig
+def chrom_filter(chrom, alias=None):
+    prefix = f"{alias}." if alias else ""
+    if chrom in CONTIGS:
+        return f"vkey_in_chrom({prefix}vkey, '{chrom}')"
+    return f"split_part({prefix}key, ':', 1) = '{chrom}'"
+
+# The vkey orders the rows by contig and position, and lets chromosome filters be ranges on it, which DuckDB answers
+# from the min/max of each row group instead of reading every key. Tables from before vkey existed get it filled in from
+# their key when they are opened for writing, and through legacy_columns when they are only read
+def ensure_vkey(connection, table):
+    connection.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS vkey BIGINT")
+    connection.execute(f"UPDATE {table} SET vkey = vkey_of(key) WHERE vkey is NULL")
+
+# The tables of an attached database that have a key but no vkey column
+def legacy_tables(connection, alias):
+    sql = f"""
+        SELECT table_name
+        FROM duckdb_columns()
+        WHERE database_name = '{alias}'
+        GROUP BY table_name
+        HAVING bool_or(column_name = 'key') AND NOT bool_or(column_name = 'vkey')
+        ORDER BY table_name
+    """
+    return [table for (table,) in connection.execute(sql).fetchall()]
+
+# The pileup table keeps only the vkey (see variants.ensure_pileup_table), every other table keeps both
+def legacy_columns(table):
+    if table == 'pileup':
+        return "* EXCLUDE (key), vkey_of(key) AS vkey"
+    return "*, vkey_of(key) AS vkey"
+
+def write_dataset(connection, table, dataset, clobber, where="TRUE"):
+    columns = connection.sql(f"SELECT * FROM {table} LIMIT 0").columns
+    # Tables from before vkey existed get it in the dataset, so every reader can filter on it
+    select = legacy_columns(table) if 'key' in columns and 'vkey' not in columns else "*"
+    if 'chrom' in columns:
+        chrom = "chrom"
+    elif 'key' in columns:
+        chrom = "split_part(key, ':', 1)"
+    else:
+        chrom = "vkey_chrom(vkey)"
+    partitions = "partition_chrom, partition_batch" if 'batch' in columns else "partition_chrom"
+    batch = ", batch AS partition_batch" if 'batch' in columns else ""
+    folder = f"{dataset}/{table}"
+    if os.path.exists(folder) and clobber == True:
+        log.logit(f"Deleting existing dataset table: {folder}")
+        shutil.rmtree(folder)
+    # Every write adds new uniquely named files, so a later batch can be appended to an existing dataset
+    sql = f"""
+        COPY (
+            SELECT {select}, {chrom} AS partition_chrom{batch}
+            FROM {table}
+            WHERE {where}
+        ) TO '{folder}' ({DATASET_OPTIONS}, PARTITION_BY ({partitions}), OVERWRITE_OR_IGNORE, FILENAME_PATTERN 'part_{{uuid}}')
+    """
+    connection.execute(sql)
+
+def duckdb_to_dataset(db_file, which_db, dataset, clobber, batch_number=None):
+    log.logit(f"Writing the {which_db} tables from {db_file} into the dataset {dataset}")
+    connection = duckdb_connect_ro(db_file)
+    os.makedirs(dataset, exist_ok=True)
+    where = f"batch = {batch_number}" if batch_number is not None else "TRUE"
+    for table in DATASET_TABLES[which_db]:
+        log.logit(f"Writing {table}...")
+        write_dataset(connection, table, dataset, clobber, where)
+    connection.close()
@@ -0,0 +1,21 @@
+import os, stat, tempfile, contextlib
+
+# mkstemp creates files readable only by their owner, so the file keeps the mode of the one it replaces, or gets this one
+DEFAULT_MODE = 0o644
+
+# Written to a temporary file next to path and moved over it once complete, so readers in other processes only ever
+# see the old file or the whole new one. The temporary file is removed if writing fails
+@contextlib.contextmanager
+def atomic_write(path, mode='wb', file_mode=DEFAULT_MODE):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=f".{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, mode) as f:
+            with contextlib.suppress(FileNotFoundError):
+                file_mode = stat.S_IMODE(os.stat(path).st_mode)
+            os.fchmod(f.fileno(), file_mode)
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
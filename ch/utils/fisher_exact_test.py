@@ -1,9 +1,34 @@
-import decimal
+import os, decimal, contextlib, fcntl
 import numpy as np
-from numba import njit
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import numba
+from numba import njit, prange
+from duckdb.typing import BIGINT, DOUBLE
+
+import ch.utils.logger as log
+import ch.utils.database as db
+import ch.utils.files as files
+
+CACHE_SIZE = 100_000_000
+BAND = 100.0
+
+# log(n!) for n up to len - 1, kept for the whole process and grown as larger tables come along. Pool workers inherit
+# it, and with a cache file (CH_TOOLKIT_LOGFAC_CACHE or set_logfac_cache) it is memory-mapped from there and shared
+# with other processes and runs
+log_factorials = {
+    'table' : np.zeros(1),
+    'cache' : os.environ.get('CH_TOOLKIT_LOGFAC_CACHE')
+}
 
 # Fisher Test using fisher package (much faster)
-def pvalue_df(df):
+# Only the distinct (PoN_RefDepth, PoN_AltDepth, rd, ad) tables are computed, once each, and scattered back to the rows.
+# With a cache database, tables computed in earlier batches are looked up there instead (see cached_pvalues)
+# With a threshold, tables whose p-value bounds (see ufet_bounds) lie clearly below threshold / band or clearly above
+# threshold * band keep the bound nearest the threshold, and only the others are computed exactly. Filtering on any
+# cut-off within the band then gives the same rows as the exact p-values. df['exact'] marks the exact ones
+def pvalue_df(df, cache=None, cache_size=CACHE_SIZE, threshold=None, band=BAND):
     df['rd'] = df['format_ref_fwd'] + df['format_ref_rev']
     df['ad'] = df['format_alt_fwd'] + df['format_alt_rev']
 
@@ -14,18 +39,153 @@ def pvalue_df(df):
     #df['pvalue'] = twosided
     #df['pvalue'] = [fisher_exact([[r[0], r[1]], [r[2], r[3]]])[1] for r in  df[['PoN_RefDepth','PoN_AltDepth','rd','ad']].values]
 
-    maxSum = df[['PoN_RefDepth','PoN_AltDepth','rd','ad']].sum(axis = 1).max()
-    logFac = unitLogFac(maxSum)
-    df['pvalue'] = [ufet(r[0], r[1], r[2], r[3], logFac) for r in  df[['PoN_RefDepth','PoN_AltDepth','rd','ad']].values]
+    tables = df[['PoN_RefDepth','PoN_AltDepth','rd','ad']].to_numpy(dtype=np.int64)
+    pvalues, exact = pvalue_rows(tables, cache, cache_size, threshold, band)
+    df['pvalue'] = pvalues
+    df['exact'] = exact
 
-    # Checking for conditions
-    # 1. When PoN_AltDepth is 0
-    # 2. When PoN VAF >= Variant VAF
-    df.loc[(df['PoN_AltDepth'] == 0) & (df['PoN_RefDepth'] > 0), 'pvalue'] = 0
-    df.loc[(df['PoN_AltDepth'] / (df['PoN_AltDepth'] + df['PoN_RefDepth']) >= df['ad'] / (df['ad'] + df['rd'])), 'pvalue'] = 1
-    df.loc[((df['PoN_AltDepth'] == 0) & (df['PoN_AltDepth'] != 0)) & ((df['rd'] == 0) & df['ad'] != 0), 'pvalue'] = 1
+    df['pvalue'] = check_conditions(df['pvalue'].to_numpy(), *[df[column].to_numpy() for column in ['PoN_RefDepth','PoN_AltDepth','rd','ad']])
     return(df)
 
+# The p-value and whether it is exact for each row of an (n, 4) array of (PoN_RefDepth, PoN_AltDepth, rd, ad) tables
+def pvalue_rows(tables, cache=None, cache_size=CACHE_SIZE, threshold=None, band=BAND):
+    tables, rows = np.unique(tables, axis=0, return_inverse=True)
+    log.logit(f"Computing {len(tables)} distinct contingency tables for {len(rows)} variants")
+    if threshold is None:
+        exact = np.ones(len(tables), dtype=bool)
+        pvalues = exact_pvalues(tables, cache, cache_size)
+    else:
+        logFac = logfac_table(tables.sum(axis = 1).max())
+        lower, upper = ufet_bounds_batch(tables[:, 0], tables[:, 1], tables[:, 2], tables[:, 3], logFac)
+        significant = upper < threshold / band
+        exact = ~significant & (lower <= threshold * band)
+        pvalues = np.where(significant, upper, lower)
+        log.logit(f"{exact.sum()} of the {len(tables)} contingency tables are within a factor of {band} of {threshold} and computed exactly")
+        pvalues[exact] = exact_pvalues(tables[exact], cache, cache_size)
+    return pvalues[rows.reshape(-1)], exact[rows.reshape(-1)]
+
+# Checking for conditions
+# 1. When PoN_AltDepth is 0
+# 2. When PoN VAF >= Variant VAF
+def check_conditions(pvalues, pon_ref, pon_alt, rd, ad):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pvalues[(pon_alt == 0) & (pon_ref > 0)] = 0
+        pvalues[(pon_alt / (pon_alt + pon_ref) >= ad / (ad + rd))] = 1
+        pvalues[((pon_alt == 0) & (pon_alt != 0)) & ((rd == 0) & ad != 0)] = 1
+    return pvalues
+
+# fisher_exact_test(PoN_RefDepth, PoN_AltDepth, rd, ad) computes the p-values inside SQL, one Arrow batch at a time,
+# e.g. COPY (SELECT variant_id, fisher_exact_test(...) FROM ...) TO ... never holds all the rows in a DataFrame.
+# Rows with a NULL argument get NULL. It is only added to the connections that ask for it.
+# DuckDB calls it from its own threads, which numba's parallel kernels do not support, so each batch runs ufet_rows and
+# DuckDB runs the batches in parallel instead. DuckDB 1.0 can hang running it straight over joins of attached
+# databases, so those rows are best gathered into a table first (see callers.fisher_test_chromosome)
+def create_fisher_function(connection):
+    functions = connection.execute("SELECT function_name FROM duckdb_functions() WHERE function_name = 'fisher_exact_test'").fetchall()
+    if not functions:
+        connection.create_function('fisher_exact_test', fisher_exact_test_arrow, [BIGINT, BIGINT, BIGINT, BIGINT], DOUBLE, type='arrow')
+    return connection
+
+def fisher_exact_test_arrow(pon_ref, pon_alt, rd, ad):
+    arguments = [pon_ref, pon_alt, rd, ad]
+    valid = np.logical_and.reduce([pc.is_valid(argument).to_numpy(zero_copy_only=False) for argument in arguments])
+    columns = [pc.fill_null(argument, 0).to_numpy().astype(np.int64)[valid] for argument in arguments]
+    pvalues = np.zeros(len(valid))
+    if valid.any():
+        tables, rows = np.unique(np.column_stack(columns), axis=0, return_inverse=True)
+        logFac = logfac_table(tables.sum(axis = 1).max())
+        pvalues[valid] = check_conditions(ufet_rows(tables[:, 0], tables[:, 1], tables[:, 2], tables[:, 3], logFac)[rows.reshape(-1)], *columns)
+    return pa.array(pvalues, mask=~valid)
+
+def exact_pvalues(tables, cache, cache_size):
+    if len(tables) == 0:
+        return np.empty(0)
+    if cache is None:
+        return pvalue_tables(tables)
+    return cached_pvalues(tables, cache, cache_size)
+
+def pvalue_tables(tables):
+    maxSum = tables.sum(axis = 1).max()
+    logFac = logfac_table(maxSum)
+    return ufet_batch(tables[:, 0], tables[:, 1], tables[:, 2], tables[:, 3], logFac)
+
+# Pool workers each use their share of the threads (see ch.utils.database.worker_pool) for the compiled batches
+def set_threads(threads):
+    numba.set_num_threads(max(1, min(threads, numba.config.NUMBA_NUM_THREADS)))
+
+def set_logfac_cache(cache):
+    if cache is not None and cache != log_factorials['cache']:
+        log_factorials['cache'] = cache
+        log_factorials['table'] = np.zeros(1)
+
+# Returns the log factorials up to at least m. The table at least doubles when it grows, and the new entries continue
+# the running sum of unitLogFac, so they are the same values it would compute
+def logfac_table(m):
+    table = log_factorials['table']
+    if len(table) > m:
+        return table
+    cache = log_factorials['cache']
+    if cache is not None and os.path.exists(cache):
+        table = np.load(cache, mmap_mode='r')
+    if len(table) <= m:
+        size = max(m + 1, 2 * len(table))
+        log.logit(f"Growing the log factorial table from {len(table)} to {size} entries")
+        table = np.concatenate((table, extendLogFac(table[-1], len(table), size)))
+        if cache is not None:
+            table = save_logfac_table(table, cache)
+    log_factorials['table'] = table
+    return table
+
+# Written atomically, so other processes only ever map a complete table
+def save_logfac_table(table, cache):
+    with files.atomic_write(cache) as f:
+        np.save(f, table)
+    return np.load(cache, mmap_mode='r')
+
+# The cache is a DuckDB file of tables with their p-value and the last time they were used. It is kept to cache_size
+# tables by dropping the ones unused for the longest
+def cached_pvalues(tables, cache, cache_size):
+    lookup = pd.DataFrame(tables, columns=['a', 'b', 'c', 'd'])
+    lookup['i'] = np.arange(len(tables))
+    sql = """
+        SELECT l.i, p.pvalue
+        FROM lookup l JOIN pvalues p ON l.a = p.a AND l.b = p.b AND l.c = p.c AND l.d = p.d
+    """
+    with cache_lock(cache):
+        connection = db.duckdb_connect_rw(cache, False)
+        connection.execute("CREATE TABLE IF NOT EXISTS pvalues(a BIGINT, b BIGINT, c BIGINT, d BIGINT, pvalue DOUBLE, last_used TIMESTAMP)")
+        hits = connection.execute(sql).df()
+        connection.close()
+    pvalues = np.empty(len(tables))
+    found = np.zeros(len(tables), dtype=bool)
+    pvalues[hits['i'].to_numpy()] = hits['pvalue'].to_numpy()
+    found[hits['i'].to_numpy()] = True
+    log.logit(f"Found {found.sum()} of the {len(tables)} contingency tables in {cache}")
+    if not found.all():
+        pvalues[~found] = pvalue_tables(tables[~found])
+    computed = lookup[~found].drop('i', axis=1)
+    computed['pvalue'] = pvalues[~found]
+    # Another worker may have added some of the same tables while these were being computed
+    with cache_lock(cache):
+        connection = db.duckdb_connect_rw(cache, False)
+        connection.execute("BEGIN TRANSACTION")
+        connection.execute("UPDATE pvalues SET last_used = current_timestamp FROM lookup l WHERE pvalues.a = l.a AND pvalues.b = l.b AND pvalues.c = l.c AND pvalues.d = l.d")
+        connection.execute("INSERT INTO pvalues SELECT c.a, c.b, c.c, c.d, c.pvalue, current_timestamp FROM computed c ANTI JOIN pvalues p ON c.a = p.a AND c.b = p.b AND c.c = p.c AND c.d = p.d")
+        connection.execute(f"DELETE FROM pvalues WHERE rowid IN (SELECT rowid FROM pvalues ORDER BY last_used DESC OFFSET {cache_size})")
+        connection.execute("COMMIT")
+        connection.close()
+    return pvalues
+
+# DuckDB only lets one process open a database for writing, so workers sharing the cache take turns through a lock file
+@contextlib.contextmanager
+def cache_lock(cache):
+    with open(f"{cache}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
 @njit
 def ulogHypergeometricProb(logFacs, a, b, c, d):
     return logFacs[a+b] + logFacs[c+d] + logFacs[a+c] + logFacs[b+d] \
@@ -40,6 +200,16 @@ def unitLogFac(m):
         res[i] += res[i-1]
     return res
 
+# log(n!) for n from start up to size - 1, given log((start - 1)!), summed the same way as unitLogFac
+@njit
+def extendLogFac(last, start, size):
+    res = np.arange(start, size)
+    res = np.log(res)
+    res[0] += last
+    for i in np.arange(1, len(res)):
+        res[i] += res[i-1]
+    return res
+
 @njit
 def ufet(a, b, c, d, logFacs):
     n = a + b + c + d
@@ -56,4 +226,34 @@ def ufet(a, b, c, d, logFacs):
     logpValue = logpCutoff + np.log(pFraction)
     pval = np.exp(logpValue)
 
-    return pval
\ No newline at end of file
+    return pval
+
+# ufet sums the probabilities of the tables no more likely than the observed one, relative to it, so every term is at
+# most 1 and the observed table itself adds exactly 1. The p-value is therefore between the observed probability and
+# that times the number of tables with the same margins, which takes no summation
+@njit
+def ufet_bounds(a, b, c, d, logFacs):
+    f = 10_000_000
+    logpCutoff = round(ulogHypergeometricProb(logFacs, a, b, c, d) * f) / f
+    tables = min(a+b, a+c) - max(0, a-d) + 1
+    lower = np.exp(logpCutoff)
+    return lower, min(1.0, lower * tables)
+
+@njit(parallel=True)
+def ufet_bounds_batch(a, b, c, d, logFacs):
+    lower = np.empty(len(a))
+    upper = np.empty(len(a))
+    for i in prange(len(a)):
+        lower[i], upper[i] = ufet_bounds(a[i], b[i], c[i], d[i], logFacs)
+    return lower, upper
+
+# The whole batch in one compiled call, with the rows spread across all the threads numba is allowed (NUMBA_NUM_THREADS)
+@njit(parallel=True)
+def ufet_batch(a, b, c, d, logFacs):
+    pvalues = np.empty(len(a))
+    for i in prange(len(a)):
+        pvalues[i] = ufet(a[i], b[i], c[i], d[i], logFacs)
+    return pvalues
+
+# The same loop compiled without parallel and without the GIL, for callers that bring their own threads
+ufet_rows = njit(nogil=True)(ufet_batch.py_func)
@@ -459,16 +459,25 @@ def determine_pathogenicity(df, total_samples, debug):
 # - PoN Edge Case of 0
 def ch_to_df(temp_connection, mutect_db, vardict_db, annotation_db, pvalue, ch_pd_one, debug):
     log.logit(f"Processing variants from databases...")
-    temp_connection.execute("PRAGMA memory_limit='16GB'")
-    temp_connection.execute(f"ATTACH \'{mutect_db}\' as mutect_db (READ_ONLY)")
-    temp_connection.execute(f"ATTACH \'{vardict_db}\' as vardict_db (READ_ONLY)")
-    temp_connection.execute(f"ATTACH \'{annotation_db}\' as annotation_db (READ_ONLY)")
+    db.duckdb_attach(temp_connection, mutect_db, "mutect_db")
+    db.duckdb_attach(temp_connection, vardict_db, "vardict_db")
+    db.duckdb_attach(temp_connection, annotation_db, "annotation_db")
     total_sample = temp_connection.execute(f"SELECT COUNT(DISTINCT sample_id) FROM mutect_db.mutect").fetchone()[0]
     if ch_pd_one:
         ch_pd_string = f"(ch_pd == 1)"
     else:
         ch_pd_string = "TRUE"
     with indent(4, quote=' >'):
+        # The ASXL1 variants that are always kept, matched on vkey in the annotation and caller tables alike
+        log.logit(f"Creating the always_keep table...")
+        sql = f"""
+        CREATE TABLE always_keep AS
+        SELECT vkey('chr20', 32434638, 'A', 'AG') AS vkey
+        UNION ALL
+        SELECT vkey('chr20', 32434638, 'A', 'AGG');
+        """
+        if debug: log.logit(f"Executing: {sql}")
+        temp_connection.execute(sql)
         log.logit(f"Creating the pd_filtered table...")
         sql = f"""
         CREATE TABLE pd_filtered AS
@@ -481,11 +490,11 @@ def ch_to_df(temp_connection, mutect_db, vardict_db, annotation_db, pvalue, ch_p
             (max_gnomADg_AF_VEP < 0.005 OR max_gnomADg_AF_VEP is NULL) AND
             (max_pop_gnomAD_AF < 0.0005 OR max_pop_gnomAD_AF is NULL) AND
             {ch_pd_string}
-        ) OR (vep.key = 'chr20:32434638:A:AG' OR vep.key = 'chr20:32434638:A:AGG');
+        ) OR vep.vkey IN (SELECT vkey FROM always_keep);
         """
         if debug: log.logit(f"Executing: {sql}")
         temp_connection.execute(sql)
-        temp_connection.execute("DETACH annotation_db;")
+        db.duckdb_detach(temp_connection, "annotation_db")
         log.logit(f"Creating the mutect_filtered table...")
         sql = f"""
         CREATE TABLE mutect_filtered AS
@@ -519,11 +528,11 @@ def ch_to_df(temp_connection, mutect_db, vardict_db, annotation_db, pvalue, ch_p
                     SELECT variant_id
                     FROM pd_filtered
                 )
-            ) OR (m.key = 'chr20:32434638:A:AG' OR m.key = 'chr20:32434638:A:AGG');
+            ) OR m.vkey IN (SELECT vkey FROM always_keep);
         """
         if debug: log.logit(f"Executing: {sql}")
         temp_connection.execute(sql)
-        temp_connection.execute("DETACH mutect_db;")
+        db.duckdb_detach(temp_connection, "mutect_db")
         log.logit(f"Creating the vardict_filtered table...")
         sql = f"""
         CREATE TABLE vardict_filtered AS
@@ -538,11 +547,11 @@ def ch_to_df(temp_connection, mutect_db, vardict_db, annotation_db, pvalue, ch_p
                 SELECT variant_id
                 FROM pd_filtered
             )
-        ) OR (key = 'chr20:32434638:A:AG' OR key = 'chr20:32434638:A:AGG');
+        ) OR vkey IN (SELECT vkey FROM always_keep);
         """
         if debug: log.logit(f"Executing: {sql}")
         temp_connection.execute(sql)
-        temp_connection.execute("DETACH vardict_db;")
+        db.duckdb_detach(temp_connection, "vardict_db")
         log.logit(f"Calculating n_samples...")
         sql = """
         CREATE TABLE n_samples_and_median_af AS
@@ -648,12 +657,12 @@ def create_caller_filtered(connection, caller, chrom, outfile, debug):
             WITH p AS (
                 SELECT variant_id
                 FROM annotation_db.pd
-                WHERE key LIKE '{chrom}:%'
+                WHERE {db.chrom_filter(chrom)}
             ),
             mchr AS (
                 SELECT *
                 FROM caller_db.mutect
-                WHERE key LIKE '{chrom}:%' AND (
+                WHERE {db.chrom_filter(chrom)} AND (
                 (
                     mutect_filter = '[PASS]' OR (
                     (
@@ -686,12 +695,12 @@ def create_caller_filtered(connection, caller, chrom, outfile, debug):
             WITH p AS (
                 SELECT variant_id
                 FROM annotation_db.pd
-                WHERE key LIKE '{chrom}:%'
+                WHERE {db.chrom_filter(chrom)}
             ),
             vchr AS (
                 SELECT *
                 FROM caller_db.vardict
-                WHERE key LIKE '{chrom}:%' AND
+                WHERE {db.chrom_filter(chrom)} AND
                 (
                     vardict_filter = '[PASS]' AND
                     pon_2at2_percent is NULL AND
@@ -721,14 +730,13 @@ def ch_variants_only(caller_db, base_db, caller, annotation_db, chrom, debug):
     log.logit(f"Creating EXOME ONLY {caller_db} for {chrom}...")
     base_output = f"exome.{chrom}"
     temp_connection = db.duckdb_connect_rw(f"{base_db}.{base_output}.db", True)
-    temp_connection.execute("PRAGMA memory_limit='16GB'")
-    temp_connection.execute(f"ATTACH \'{caller_db}\' as caller_db (READ_ONLY)")
-    temp_connection.execute(f"ATTACH \'{annotation_db}\' as annotation_db (READ_ONLY)")
+    db.duckdb_attach(temp_connection, caller_db, "caller_db", chrom)
+    db.duckdb_attach(temp_connection, annotation_db, "annotation_db", chrom)
     with indent(4, quote=' >'):
         log.logit(f"Creating the filtered {caller} parquet file...")
         create_caller_filtered(temp_connection, caller, chrom, f"{base_db}.{base_output}", debug)
-    temp_connection.execute("DETACH caller_db;")       
-    temp_connection.execute("DETACH annotation_db;")
+    db.duckdb_detach(temp_connection, "caller_db")
+    db.duckdb_detach(temp_connection, "annotation_db")
     temp_connection.close()
     log.logit(f"Finished creating: {base_db}.{base_output}.parquet")
     os.remove(f"{base_db}.{base_output}.db")
@@ -737,10 +745,10 @@ def merge_ch_variants(base_db, caller):
     # Assuming that the above function creates parquet files...
     log.logit(f"Creating: {base_db}.exome.db from {base_db}.exome.*.parquet files")
     connection = db.duckdb_connect_rw(f"{base_db}.exome.db", True)
-    connection.execute("PRAGMA memory_limit='16GB'")
     import ch.vdbtools.handlers.callers as callers
     callers.setup_caller_tbl(connection, caller)
-    sql = f"INSERT INTO {caller} SELECT * FROM read_parquet('{base_db}.exome.*.parquet')"
+    sql = f"INSERT INTO {caller} BY NAME SELECT * FROM read_parquet('{base_db}.exome.*.parquet') ORDER BY vkey_of(key)"
     connection.execute(sql)
+    db.ensure_vkey(connection, caller)
     log.logit(f"Finished creating {base_db}.exome.db")
     connection.close()
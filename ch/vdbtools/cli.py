@@ -10,11 +10,16 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 @click.group(context_settings=CONTEXT_SETTINGS)
 @click.version_option(version=__version__)
-def cli():
+@click.option('--memory-limit', 'memory_limit', type=click.STRING, envvar='CH_TOOLKIT_MEMORY_LIMIT', default=None, required=False, help="Total memory DuckDB may use, e.g. 64GB, shared by all parallel workers [default: 80% of the cgroup or machine memory]")
+@click.option('--duckdb-threads', 'threads', type=click.INT, envvar='CH_TOOLKIT_THREADS', default=None, required=False, help="Total threads DuckDB may use, shared by all parallel workers [default: the CPUs available to this process]")
+@click.option('--temp-directory', 'temp_directory', type=click.Path(), envvar='CH_TOOLKIT_TEMP_DIRECTORY', default=None, required=False, help="Where DuckDB spills to disk when it runs out of memory")
+@click.option('--preserve-insertion-order/--no-preserve-insertion-order', 'preserve_insertion_order', default=True, show_default=True, help="Keep the row order of queries without ORDER BY, turning it off lowers memory use")
+def cli(memory_limit, threads, temp_directory, preserve_insertion_order):
     '''A collection of db related tools for handling sample data.'''
     # to make this script/module behave nicely with unix pipes
     # http://newbebweb.blogspot.com/2012/02/python-head-ioerror-errno-32-broken.html
     signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    db.set_budget(memory_limit, threads, temp_directory, preserve_insertion_order)
 
 @cli.command('import-samples', short_help="Loads a CSV containing samples into samples database")
 @click.option('--samples', '-s', type=click.Path(exists=True), required=True, help="A CSV file with the samples")
@@ -38,16 +43,53 @@ def import_samples(samples, sample_duckdb, batch_number, debug, clobber):
 @click.option('--input-vcf', 'input_vcf', type=click.Path(exists=True), required=True, help="The VCF to be imported into the database")
 @click.option('--cdb', '-i', 'database', type=click.Path(), required=True, help="The duckdb database to import the caller data")
 @click.option('--batch-number', '-b', type=click.INT, required=True, help="The batch number of this import set")
+@click.option('--chunk-size', type=click.INT, required=False, show_default=True, default=1_000_000, help="Number of VCF records held in memory at a time")
+@click.option('--reader', type=click.Choice(['gzip', 'htslib'], case_sensitive=False), required=False, show_default=True, default='gzip', help="Read the VCF with python's gzip or with htslib, htslib requires a bgzip compressed VCF with a tabix index")
+@click.option('--region', type=click.STRING, required=False, default=None, help="Only import the records in this region e.g. chr1 or chr1:1000-2000, requires --reader htslib")
+@click.option('--threads', type=click.INT, required=False, show_default=True, default=1, help="Number of threads used by htslib to decompress the VCF")
 @click.option('--debug', '-d', is_flag=True, show_default=True, default=False, required=False, help="Print extra debugging output")
 @click.option('--clobber', '-f', is_flag=True, show_default=True, default=False, required=False, help="If exists, delete existing duckdb file and then start from scratch")
-def import_vcf(caller, input_vcf, database, batch_number, clobber, debug):
+def import_vcf(caller, input_vcf, database, batch_number, chunk_size, reader, region, threads, clobber, debug):
     """
     variantdb is a path to a sample variant sqlite database.
     """
     import ch.vdbtools.importer as importer
-    importer.import_vcf(database, input_vcf, caller, batch_number, clobber, debug)
+    importer.import_vcf(database, input_vcf, caller, batch_number, chunk_size, reader, region, threads, clobber, debug)
     puts(colored.green(f"---> Successfully imported ({input_vcf}) into {database}"))
 
+@cli.command('import-batch-vcf', short_help="import a directory or manifest of vcf files into sample variant databases")
+@click.option('--caller', 'caller',
+              type=click.Choice(['mutect', 'vardict'], case_sensitive=False),
+              required=True,
+              help="Type of VCF files to import")
+@click.option('--vcf-path', '-i', 'vcf_path', type=click.Path(exists=True), required=False, default=None, help="The directory with the *.vcf.gz files to be imported")
+@click.option('--manifest', '-m', type=click.Path(exists=True), required=False, default=None, help="A file with the path of one VCF to be imported per line")
+@click.option('--db-path', '-p', type=click.Path(), required=True, help="The directory to store the sample databases in, used by merge-batch-vcf")
+@click.option('--batch-number', '-b', type=click.INT, required=True, help="The batch number of this import set")
+@click.option('--chunk-size', type=click.INT, required=False, show_default=True, default=1_000_000, help="Number of VCF records held in memory at a time, per thread")
+@click.option('--reader', type=click.Choice(['gzip', 'htslib'], case_sensitive=False), required=False, show_default=True, default='gzip', help="Read the VCF with python's gzip or with htslib, htslib requires a bgzip compressed VCF with a tabix index")
+@click.option('--region', type=click.STRING, required=False, default=None, help="Only import the records in this region e.g. chr1 or chr1:1000-2000, requires --reader htslib")
+@click.option('--threads', 'cores', type=click.INT, required=False, show_default=True, default=1, help="Number of Threads used for parallelization")
+@click.option('--debug', '-d', is_flag=True, show_default=True, default=False, required=False, help="Print extra debugging output")
+@click.option('--clobber', '-f', is_flag=True, show_default=True, default=False, required=False, help="If exists, delete existing duckdb files and then start from scratch")
+def import_batch_vcf(caller, vcf_path, manifest, db_path, batch_number, chunk_size, reader, region, cores, debug, clobber):
+    """
+    Imports many VCFs at once into one sample database per VCF inside --db-path\n
+    Provide either --vcf-path or --manifest. A VCF that fails to import does not stop the others,
+    a summary of the rows and time taken for each VCF is written to --db-path. Rerunning without --clobber
+    skips the VCFs that were already imported
+    """
+    if (vcf_path is None) == (manifest is None):
+        log.logit("ERROR: Please provide exactly one of --vcf-path or --manifest", color="red")
+        sys.exit(1)
+    import ch.vdbtools.importer as importer
+    summary = importer.import_vcf_batch(vcf_path, manifest, db_path, caller, batch_number, chunk_size, reader, region, cores, debug, clobber)
+    failed = summary['error'].notnull().sum()
+    if failed > 0:
+        log.logit(f"---> {failed} of {len(summary)} VCFs failed to import into {db_path}", color="red")
+        sys.exit(1)
+    log.logit(f"---> Successfully imported {len(summary)} VCFs into {db_path}", color="green")
+
 @cli.command('merge-batch-vcf', short_help="Combines all sample vcfs databases into a single database")
 @click.option('--db-path', '-p', type=click.Path(exists=True), required=True, help="The path to where all the databases for this batch is stored")
 @click.option('--cdb', 'caller_db', type=click.Path(), required=True, help="The variant database to import the batch into")
@@ -73,28 +115,30 @@ def merge_batch_vcf(db_path, caller_db, variant_db, sample_db, caller, batch_num
 @click.option('--input-vcf', '-i', 'input_vcf', type=click.Path(exists=True), required=True, help="The VCF to be imported")
 @click.option('--vdb', 'variant_db', type=click.Path(), required=True, help="The variant database to import the VCF into")
 @click.option('--batch-number', '-b', type=click.INT, required=True, help="The batch number of this import set")
+@click.option('--engine', type=click.Choice(['duckdb', 'pandas'], case_sensitive=False), required=False, show_default=True, default='duckdb', help="Read the VCF with DuckDB's CSV reader or with pandas")
 @click.option('--debug', '-d', is_flag=True, show_default=True, default=False, required=False, help="Print extra debugging output")
 @click.option('--clobber', '-f', is_flag=True, show_default=True, default=False, required=False, help="If exists, delete existing duckdb file and then start from scratch")
-def import_sample_variants(input_vcf, variant_db, batch_number, debug, clobber):
+def import_sample_variants(input_vcf, variant_db, batch_number, engine, debug, clobber):
     """
     Registering variants into the duckdb database.
     """
     import ch.vdbtools.importer as importer
-    importer.import_sample_variants(input_vcf, variant_db, batch_number, debug, clobber)
+    importer.import_sample_variants(input_vcf, variant_db, batch_number, engine, debug, clobber)
     log.logit(f"---> Successfully imported ({input_vcf})", color="green")
 
 @cli.command('merge-batch-variants', short_help="Combines all sample variant databases into a single database")
 @click.option('--db-path', '-p', type=click.Path(exists=True), required=True, help="The path to where all the databases for this batch is stored")
 @click.option('--vdb', 'variant_db', type=click.Path(), required=True, help="The variant database to import the batch into")
 @click.option('--batch-number', '-b', type=click.INT, required=True, help="The batch number of this import set")
+@click.option('--threads', 'cores', type=click.INT, required=False, show_default=True, default=1, help="Number of Threads used for parallelization")
 @click.option('--debug', '-d', is_flag=True, show_default=True, default=False, required=False, help="Print extra debugging output")
 @click.option('--clobber', '-f', is_flag=True, show_default=True, default=False, required=False, help="If exists, delete existing duckdb file and then start from scratch")
-def merge_batch_variants(db_path, variant_db, batch_number, debug, clobber):
+def merge_batch_variants(db_path, variant_db, batch_number, cores, debug, clobber):
     """
     Ingest the variants in a batch into main variants database
     """
     import ch.vdbtools.importer as importer
-    importer.import_variant_batch(db_path, variant_db, batch_number, debug, clobber)
+    importer.import_variant_batch(db_path, variant_db, batch_number, cores, debug, clobber)
     log.logit(f"---> Successfully imported variant batch ({batch_number}) into {variant_db}", color="green")
 
 @cli.command('bcbio-filter', short_help="Filters variants in the Vardict Database using the BCBIO filter")
@@ -173,9 +217,28 @@ def chromosome_to_caller(chr_path, caller_db, caller, debug):
     NOTE: This will create a completely new <Mutect|Vardict> database. If columns have been changed in the chromosomes, then the new database will reflect those changes.
     """
     import ch.vdbtools.process as process
-    process.caller_to_chromosome(chr_path, caller_db, caller, debug)
+    process.chromosome_to_caller(chr_path, caller_db, caller, debug)
     log.logit(f"---> Successfully imported chromosomes from {chr_path} into {caller_db}", color="green")
 
+@cli.command('database-to-dataset', short_help="Writes <Mutect|Vardict|Variant|Annotation|Pileup> database into a Parquet dataset partitioned by chromosome and batch")
+@click.option('--db', 'db', type=click.Path(exists=True), required=True, help="The database to write out")
+@click.option('--which_db', 'which_db',
+              type=click.Choice(['mutect', 'vardict', 'variant', 'annotation', 'pileup'], case_sensitive=False),
+              required=True,
+              help="The specific database being processed")
+@click.option('--dataset', 'dataset', type=click.Path(), required=True, help="The directory of the Parquet dataset")
+@click.option('--debug', '-d', is_flag=True, show_default=True, default=False, required=False, help="Print extra debugging output")
+@click.option('--clobber', '-f', is_flag=True, show_default=True, default=False, required=False, help="If exists, delete the existing tables in the dataset, otherwise the rows are added to them")
+def database_to_dataset(db, which_db, dataset, debug, clobber):
+    """
+    Writes the <Mutect|Vardict|Variant|Annotation|Pileup> database into a Parquet dataset partitioned by chromosome and batch\n
+    The dataset can be given instead of the database to database-to-chromosome, chromosome-to-caller (--chr-path) and reduce-db,
+    which then only read the partitions of the chromosome and batch being processed
+    """
+    import ch.vdbtools.process as process
+    process.db_to_dataset(db, which_db, dataset, debug, clobber)
+    log.logit(f"---> Successfully wrote {db} into the dataset {dataset}", color="green")
+
 @cli.command('dump-variants', short_help="dumps all variants inside duckdb into a VCF file")
 @click.option('--vdb', 'variant_db', type=click.Path(exists=True), required=True, help="The duckdb database to dump the variants from")
 @click.option('--header-type', '-t', type=click.Choice(['simple', 'dummy'], case_sensitive=False), required=False, default="dummy",
@@ -213,14 +276,18 @@ def dump_variants(variant_db, pileup_db, header_type, batch_number, chromosome,
 @click.option('--pdb', 'pileup_db', type=click.Path(), required=True, help="The duckdb database to fetch variant ID from")
 @click.option('--pon-pileup', '-p', 'pon_pileup', type=click.Path(exists=True), required=True, help="The pon pileup VCF to be imported into the variant database")
 @click.option('--batch-number', '-b', type=click.INT, required=True, help="The batch number of this variant set")
+@click.option('--chunk-size', type=click.INT, required=False, show_default=True, default=10_000_000, help="Number of pileup records held in memory at a time")
+@click.option('--reader', type=click.Choice(['gzip', 'htslib'], case_sensitive=False), required=False, show_default=True, default='gzip', help="Read the VCF with python's gzip or with htslib, htslib requires a bgzip compressed VCF with a tabix index")
+@click.option('--region', type=click.STRING, required=False, default=None, help="Only import the pileup records in this region e.g. chr1 or chr1:1000-2000, requires --reader htslib")
+@click.option('--threads', type=click.INT, required=False, show_default=True, default=1, help="Number of threads used by htslib to decompress the VCF")
 @click.option('--debug', '-d', is_flag=True, show_default=True, default=False, required=False, help="Print extra debugging output")
 @click.option('--clobber', '-f', is_flag=True, show_default=True, default=False, required=False, help="If exists, delete existing duckdb file and then start from scratch")
-def import_pon_pileup(pileup_db, variant_db, pon_pileup, batch_number, debug, clobber):
+def import_pon_pileup(pileup_db, variant_db, pon_pileup, batch_number, chunk_size, reader, region, threads, debug, clobber):
     """
     Dumps the panel of normal pileup information from into a pileup duckdb
     """
     import ch.vdbtools.importer as importer
-    importer.import_pon_pileup(pileup_db, variant_db, pon_pileup, batch_number, debug, clobber)
+    importer.import_pon_pileup(pileup_db, variant_db, pon_pileup, batch_number, chunk_size, reader, region, threads, debug, clobber)
     log.logit(f"---> Successfully imported PoN Pileup from batch ({batch_number}) into {pileup_db}", color="green")
 
 @cli.command('calculate-fishers-test', short_help="Updates the variants inside Mutect or Vardict tables with p-value from Fisher's Exact Test")
@@ -232,13 +299,19 @@ def import_pon_pileup(pileup_db, variant_db, pon_pileup, batch_number, debug, cl
               help="Type of VCF file to import")
 @click.option('--batch-number', '-b', type=click.INT, required=True, help="The batch number of this variant set")
 @click.option('--by_chromosome', '-c', is_flag=True, show_default=True, default=False, required=False, help="By chromosome or all at once")
+@click.option('--cache', 'cache', type=click.Path(), default=None, required=False, help="A duckdb database of p-values already computed, reused and extended across batches")
+@click.option('--cache-size', 'cache_size', type=click.INT, show_default=True, default=100_000_000, required=False, help="Maximum number of p-values kept in the cache, the least recently used are dropped first")
+@click.option('--threshold', 'threshold', type=click.FLOAT, default=None, required=False, help="The p-value cut-off used later on (e.g. dump-ch --pvalue), only p-values near it are computed exactly")
+@click.option('--band', 'band', type=click.FLOAT, show_default=True, default=100.0, required=False, help="With --threshold, p-values whose bounds fall outside threshold / band and threshold * band are not computed exactly")
+@click.option('--logfac-cache', 'logfac_cache', type=click.Path(), envvar='CH_TOOLKIT_LOGFAC_CACHE', default=None, required=False, help="A .npy file of log factorials, memory-mapped and grown as needed instead of being recomputed by every run")
+@click.option('--threads', 'cores', type=click.INT, required=False, show_default=True, default=1, help="Number of chromosomes tested in parallel, with --by_chromosome")
 @click.option('--debug', '-d', is_flag=True, show_default=True, default=False, required=False, help="Print extra debugging output")
-def calculate_fishers_test(pileup_db, caller_db, caller, batch_number, by_chromosome, debug):
+def calculate_fishers_test(pileup_db, caller_db, caller, batch_number, by_chromosome, cache, cache_size, threshold, band, logfac_cache, cores, debug):
     """
     Calculates the Fisher's Exact Test for all Variants within the Variant Caller
     """
     import ch.vdbtools.process as process
-    process.annotate_fisher_test(pileup_db, caller_db, caller, batch_number, by_chromosome, debug)
+    process.annotate_fisher_test(pileup_db, caller_db, caller, batch_number, by_chromosome, cache, cache_size, threshold, band, logfac_cache, cores, debug)
     log.logit(f"---> Successfully calculated the Fisher's Exact Test for variants within ({batch_number}) and {caller_db}", color="green")
 
 @cli.command('import-vep', short_help="updates variants inside duckdb with VEP information")
@@ -9,8 +9,15 @@ import ch.utils.database as db
 from clint.textui import indent
 import importlib.resources
 
+# Annotations carry the vkey of their key and are inserted sorted by it (see ch.utils.database.ensure_vkey)
+def add_vkey(df):
+    df['vkey'] = variants.vkeys_of(df['key'])
+    return df.sort_values('vkey', kind='stable')
+
 def load_df_file_into_annotation(connection, df, table, debug):
-    connection.execute("PRAGMA memory_limit='16GB'")
+    db.ensure_vkey(connection, table)
+    df = add_vkey(df)
+    df = vcf.df_to_arrow(df, vcf.table_schema(connection, table))
     sql = f"""
         INSERT INTO {table} SELECT df.*
         FROM df
@@ -222,12 +229,11 @@ def insert_vep(vep, annotation_connection, variant_connection, batch_number, deb
             if 'WildtypeProtein' in df.columns: df.drop(['WildtypeProtein', 'FrameshiftSequence'], axis=1, inplace=True)
             if annotation_connection.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='vep'").fetchone():
                 log.logit(f"The VEP table already exists, so we can insert the information directly")
-                annotation_connection.execute("SET GLOBAL pandas_analyze_sample=0")
                 load_df_file_into_annotation(annotation_connection, df, "vep", debug)
             else:
                 log.logit(f"This is the first time the VEP table is being referenced. Creating the Table.")
                 # Sometimes if the PD has too many NULL it cannot figure out the type to cast so it fails. See: https://github.com/duckdb/duckdb/issues/6811
-                annotation_connection.execute("SET GLOBAL pandas_analyze_sample=0")
+                df = vcf.df_to_arrow(add_vkey(df))
                 annotation_connection.sql("CREATE TABLE IF NOT EXISTS vep AS SELECT * FROM df")
     return total
 
@@ -245,7 +251,6 @@ def dump_variants_batch(annotation_db, batch_number, debug):
     log.logit(f"Dumping variants from batch: {batch_number} in {annotation_db} to a CSV file for AnnotatePD.", color="green")
     annotation_connection = db.duckdb_connect_ro(annotation_db)
     log.logit(f"Grabbing Variants to perform AnnotatePD")
-    annotation_connection.execute("PRAGMA memory_limit='16GB'")
     sql = f'''
             SELECT variant_id, key, Consequence, SYMBOL, EXON, AAchange, HGVSc, HGVSp, \"n.HGVSc\", \"n.HGVSp\"
             FROM vep
@@ -278,12 +283,11 @@ def import_annotate_pd(annotation_db, annotate_pd, batch_number, debug):
     df = process_annotate_pd(df, debug)
     if annotation_connection.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='pd'").fetchone():
         log.logit(f"The AnnotatePD table already exists, so we can insert the information directly")
-        annotation_connection.execute("SET GLOBAL pandas_analyze_sample=0")
         load_df_file_into_annotation(annotation_connection, df, "pd", debug)
     else:
         log.logit(f"This is the first time the AnnotatePD table is being referenced. Creating the Table.")
         # Sometimes if the PD has too many NULL it cannot figure out the type to cast so it fails. See: https://github.com/duckdb/duckdb/issues/6811
-        annotation_connection.execute("SET GLOBAL pandas_analyze_sample=0")
+        df = vcf.df_to_arrow(add_vkey(df))
         annotation_connection.sql("CREATE TABLE IF NOT EXISTS pd AS SELECT * FROM df")
     log.logit(f"Finished importing AnnotatePD information")
     log.logit(f"Variants Processed - Total: {counts}", color="green")
@@ -292,23 +296,22 @@ def import_annotate_pd(annotation_db, annotate_pd, batch_number, debug):
 def annotation_to_chromosome(annotation_db, annotation, chrom, base_db, debug):
     log.logit(f"Processing {chrom}...")
     chromosome_connection = db.duckdb_connect_rw(f"{base_db}.{chrom}.db", True)
-    chromosome_connection.execute("PRAGMA memory_limit='16GB'")
-    chromosome_connection.execute(f"ATTACH '{annotation_db}' as {annotation} (READ_ONLY)")
+    db.duckdb_attach(chromosome_connection, annotation_db, f"{annotation}_src", chrom)
     sql = f"""
             SELECT *
-            FROM {annotation}.vep a
-            WHERE key LIKE '{chrom}:%'
+            FROM {annotation}_src.vep a
+            WHERE {db.chrom_filter(chrom)}
         """
     log.logit(f"Writing out variants from vep to {base_db}.{chrom}.db")
     chromosome_connection.execute(f"CREATE TABLE vep AS {sql}")
     sql = f"""
             SELECT *
-            FROM {annotation}.pd a
-            WHERE key LIKE '{chrom}:%'
+            FROM {annotation}_src.pd a
+            WHERE {db.chrom_filter(chrom)}
         """
     log.logit(f"Writing out variants from pd to {base_db}.{chrom}.db")
     chromosome_connection.execute(f"CREATE TABLE pd AS {sql}")
-    chromosome_connection.execute(f"DETACH {annotation}")
+    db.duckdb_detach(chromosome_connection, f"{annotation}_src")
     chromosome_connection.close()
     log.logit(f"Finished processing {annotation_db}")
     log.logit(f"Done!", color = "green")
\ No newline at end of file
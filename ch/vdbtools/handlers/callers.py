@@ -1,4 +1,4 @@
-import os, glob, shutil, math
+import os, glob, shutil, math, time, tempfile
 import duckdb
 import pandas as pd
 import multiprocessing as mp
@@ -83,7 +83,9 @@ def ensure_mutect_tbl(connection):
             fisher_p_value                      decimal(22,20),
             sample_id                           integer,
             variant_id                          BIGINT,
-            batch                               integer
+            batch                               integer,
+            vkey                                BIGINT,
+            fisher_exact                        BOOLEAN
         )
     '''
     connection.execute(sql)
@@ -163,6 +165,8 @@ def ensure_vardict_tbl(connection):
             sample_id               integer,
             variant_id              BIGINT,
             batch                   integer,
+            vkey                    BIGINT,
+            fisher_exact            BOOLEAN
         )
     '''
     connection.execute(sql)
@@ -174,8 +178,20 @@ def setup_caller_tbl(connection, caller):
     elif caller == "vardict":
         log.logit("Preparing the vardict database file")
         ensure_vardict_tbl(connection)
+    db.ensure_vkey(connection, caller)
+    ensure_fisher_exact(connection, caller)
     return connection
 
+# fisher_exact records whether fisher_p_value is the exact p-value or a bound from the tiered Fisher's Exact Test
+# (see ch.utils.fisher_exact_test.pvalue_df), it is NULL until the test has been run
+def ensure_fisher_exact(connection, caller):
+    connection.execute(f"ALTER TABLE {caller} ADD COLUMN IF NOT EXISTS fisher_exact BOOLEAN")
+
+# Splits comma separated Integer fields, e.g. format_ad = 12,3, into one integer column per value
+def split_integer_fields(df, fields):
+    split = [vcf.split_integers(df[field], columns) for field, columns in fields.items()]
+    return pd.concat([df] + split, axis=1)
+
 def process_mutect(df, debug):
     log.logit(f"Formatting Mutect Dataframe...")
     df['version'] = '2.2'
@@ -187,14 +203,14 @@ def process_mutect(df, debug):
     df.loc[df['info_as_filterstatus'].isnull(), 'info_as_filterstatus'] = 'Multiallelic'
     df["info_as_filterstatus"] = df["info_as_filterstatus"].apply(lambda x: [x])
     df.loc[df['info_str'].isnull(), 'info_str'] = False
-    df[['info_mbq_ref', 'info_mbq_alt']] = df['info_mbq'].str.split(',', expand=True)
-    df[['info_mfrl_ref', 'info_mfrl_alt']] = df['info_mfrl'].str.split(',', expand=True)
-    df[['info_mmq_ref', 'info_mmq_alt']] = df['info_mmq'].str.split(',', expand=True)
-    df[['info_rpa_ref', 'info_rpa_alt']] = df['info_rpa'].str.split(',', expand=True)
-    df[['format_ref_count', 'format_alt_count']] = df['format_ad'].str.split(',', expand=True)
-    df[['format_ref_f1r2', 'format_alt_f1r2']] = df['format_f1r2'].str.split(',', expand=True)
-    df[['format_ref_f2r1', 'format_alt_f2r1']] = df['format_f2r1'].str.split(',', expand=True)
-    df[['format_ref_fwd', 'format_ref_rev', 'format_alt_fwd', 'format_alt_rev']] = df['format_sb'].str.split(',', expand=True)
+    df = split_integer_fields(df, {'info_mbq': ['info_mbq_ref', 'info_mbq_alt'],
+                                   'info_mfrl': ['info_mfrl_ref', 'info_mfrl_alt'],
+                                   'info_mmq': ['info_mmq_ref', 'info_mmq_alt'],
+                                   'info_rpa': ['info_rpa_ref', 'info_rpa_alt'],
+                                   'format_ad': ['format_ref_count', 'format_alt_count'],
+                                   'format_f1r2': ['format_ref_f1r2', 'format_alt_f1r2'],
+                                   'format_f2r1': ['format_ref_f2r1', 'format_alt_f2r1'],
+                                   'format_sb': ['format_ref_fwd', 'format_ref_rev', 'format_alt_fwd', 'format_alt_rev']})
     df['fisher_p_value'] = None
     df['sample_id'] = None
     df['variant_id'] = None
@@ -203,28 +219,8 @@ def process_mutect(df, debug):
     df = df.drop_duplicates(subset=['key', 'sample_name'], keep='first')
     return df
 
-def insert_mutect_caller(db_path, input_vcf, batch_number, clobber, debug):
-    log.logit(f"Registering mutect variants from: {input_vcf} in batch: {batch_number}", color="green")
-    counts, df = vcf.vcf_to_pd(input_vcf, "caller", batch_number, debug)
-    if 'info_sample' in df.columns:
-        df['sample_name'] = df['info_sample']
-    else:
-        if input_vcf.endswith('.vcf'):
-            df['sample_name'] = '.'.join(os.path.basename(input_vcf).split('.')[1:-1])
-        elif input_vcf.endswith('.vcf.gz'):
-            df['sample_name'] = '.'.join(os.path.basename(input_vcf).split('.')[1:-2])
-    df = process_mutect(df, debug)
-    caller_connection = db.duckdb_connect_rw(db_path, clobber)
-    setup_caller_tbl(caller_connection, "mutect")
-    vcf.duckdb_load_df_file(caller_connection, df, "mutect")
-    #! Write out parquet file
-    #parquetPath = db_path.replace(".db", ".parquet")
-    #cmd = f"COPY mutect TO '{parquetPath}' (FORMAT 'parquet')"
-    #caller_connection.execute(cmd)
-    caller_connection.close()
-    log.logit(f"Finished inserting mutect variants")
-    log.logit(f"Variants Processed - Total: {counts}", color="green")
-    log.logit(f"All Done!", color="green")
+def insert_mutect_caller(db_path, input_vcf, batch_number, chunk_size, reader, region, threads, clobber, debug):
+    return insert_caller(db_path, input_vcf, "mutect", batch_number, chunk_size, reader, region, threads, clobber, debug)
 
 def process_vardict(df, debug):
     log.logit(f"Formatting Vardict Dataframe...")
@@ -234,9 +230,9 @@ def process_vardict(df, debug):
                     'info_pon_2at2_percent':'pon_2at2_percent',
                     'info_pon_nat2_percent':'pon_nat2_percent',
                     'info_pon_max_vaf':'pon_max_vaf'}, axis=1)
-    df[['format_ref_count', 'format_alt_count']] = df['format_ad'].str.split(',', expand=True)
-    df[['format_ref_fwd', 'format_ref_rev']] = df['format_rd'].str.split(',', expand=True)
-    df[['format_alt_fwd', 'format_alt_rev']] = df['format_ald'].str.split(',', expand=True)
+    df = split_integer_fields(df, {'format_ad': ['format_ref_count', 'format_alt_count'],
+                                   'format_rd': ['format_ref_fwd', 'format_ref_rev'],
+                                   'format_ald': ['format_alt_fwd', 'format_alt_rev']})
     df['fisher_p_value'] = None
     df['sample_id'] = None
     df['variant_id'] = None
@@ -245,9 +241,10 @@ def process_vardict(df, debug):
     df = df.drop_duplicates(subset=['key', 'sample_name'], keep='first')
     return df
 
-def insert_vardict_caller(db_path, input_vcf, batch_number, clobber, debug):
-    log.logit(f"Registering vardict variants from: {input_vcf} in batch: {batch_number}", color="green")
-    counts, df = vcf.vcf_to_pd(input_vcf, "caller", batch_number, debug)
+def insert_vardict_caller(db_path, input_vcf, batch_number, chunk_size, reader, region, threads, clobber, debug):
+    return insert_caller(db_path, input_vcf, "vardict", batch_number, chunk_size, reader, region, threads, clobber, debug)
+
+def set_sample_name(df, input_vcf):
     if 'info_sample' in df.columns:
         df['sample_name'] = df['info_sample']
     else:
@@ -255,18 +252,107 @@ def insert_vardict_caller(db_path, input_vcf, batch_number, clobber, debug):
             df['sample_name'] = '.'.join(os.path.basename(input_vcf).split('.')[1:-1])
         elif input_vcf.endswith('.vcf.gz'):
             df['sample_name'] = '.'.join(os.path.basename(input_vcf).split('.')[1:-2])
-    df = process_vardict(df, debug)
+    return df
+
+# The VCF is streamed in chunks of chunk_size records into a staging table, so memory is bound by the chunk size and not
+# the size of the VCF. Duplicates are removed within each chunk and again across chunks when moving out of staging.
+def insert_caller(db_path, input_vcf, caller, batch_number, chunk_size, reader, region, threads, clobber, debug):
+    log.logit(f"Registering {caller} variants from: {input_vcf} in batch: {batch_number}", color="green")
+    process = process_mutect if caller == "mutect" else process_vardict
     caller_connection = db.duckdb_connect_rw(db_path, clobber)
-    setup_caller_tbl(caller_connection, "vardict")
-    vcf.duckdb_load_df_file(caller_connection, df, "vardict")
+    setup_caller_tbl(caller_connection, caller)
+    caller_connection.execute(f"CREATE OR REPLACE TEMP TABLE {caller}_staging AS SELECT * EXCLUDE (vkey, fisher_exact), 0::BIGINT AS row_order FROM {caller} LIMIT 0")
+    counts = 0
+    with indent(4, quote=' >'):
+        for count, df in vcf.caller_to_chunks(input_vcf, batch_number, chunk_size, debug, reader, region, threads):
+            df = set_sample_name(df, input_vcf)
+            df = process(df, debug)
+            df['row_order'] = df.index + counts
+            vcf.duckdb_load_df_file(caller_connection, df, f"{caller}_staging")
+            counts += count
+            log.logit(f"{counts} variants loaded.")
+    sql = f"""
+        INSERT INTO {caller} BY NAME
+        SELECT * EXCLUDE (row_order), vkey_of(key) AS vkey
+        FROM {caller}_staging
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY key, sample_name ORDER BY row_order) = 1
+        ORDER BY row_order
+    """
+    log.logit(f"Removing any duplicate variants across chunks")
+    if debug: log.logit(f"Executing: {sql}")
+    caller_connection.execute(sql)
+    caller_connection.execute(f"DROP TABLE {caller}_staging")
     #! Write out parquet file
     #parquetPath = db_path.replace(".db", ".parquet")
-    #cmd = f"COPY vardict TO '{parquetPath}' (FORMAT 'parquet')"
+    #cmd = f"COPY {caller} TO '{parquetPath}' (FORMAT 'parquet')"
     #caller_connection.execute(cmd)
     caller_connection.close()
-    log.logit(f"Finished inserting vardict variants")
+    log.logit(f"Finished inserting {caller} variants")
     log.logit(f"Variants Processed - Total: {counts}", color="green")
     log.logit(f"All Done!", color="green")
+    return counts
+
+def caller_db_name(db_path, input_vcf):
+    name = os.path.basename(input_vcf)
+    for extension in ['.vcf.gz', '.vcf']:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            break
+    return os.path.join(db_path, name + ".db")
+
+# The rows of a sample database left by an earlier run, or None when there is none to reuse
+def imported_caller_rows(db_file, caller):
+    if not os.path.exists(db_file):
+        return None
+    try:
+        connection = db.duckdb_connect_ro(db_file)
+        rows = connection.execute(f"SELECT count(*) FROM {caller}").fetchone()[0]
+        connection.close()
+    except duckdb.Error:
+        return None
+    return rows if rows > 0 else None
+
+# Run inside the worker pool, any failure is returned rather than raised so one bad VCF does not stop the rest of the batch.
+# The database is built under a temporary name and only moved into place once complete, so a rerun without clobber can
+# skip every VCF that already has one instead of importing it a second time
+def import_caller_file(index, input_vcf, db_path, caller, batch_number, chunk_size, reader, region, clobber, debug):
+    db_file = caller_db_name(db_path, input_vcf)
+    log.logit(f"Processing: {index} - {input_vcf}")
+    start = time.time()
+    if not clobber:
+        rows = imported_caller_rows(db_file, caller)
+        if rows is not None:
+            log.logit(f"Skipping {input_vcf}, already imported into {db_file}")
+            return input_vcf, db_file, rows, time.time() - start, None, True
+    tmp_file = f"{db_file}.tmp"
+    try:
+        counts = insert_caller(tmp_file, input_vcf, caller, batch_number, chunk_size, reader, region, 1, True, debug)
+        os.replace(tmp_file, db_file)
+        error = None
+    except Exception as e:
+        log.logit(f"ERROR: Failed to import {input_vcf}: {e}", color="red")
+        counts = 0
+        error = str(e).replace('\t', ' ').replace('\n', ' ')
+    finally:
+        for file in [tmp_file, f"{tmp_file}.wal"]:
+            if os.path.exists(file): os.unlink(file)        # Do not leave a partial database behind
+    return input_vcf, db_file, counts, time.time() - start, error, False
+
+def insert_caller_files(input_vcfs, db_path, caller, batch_number, chunk_size, reader, region, cores, debug, clobber):
+    log.logit(f"Registering {len(input_vcfs)} {caller} VCFs from batch: {batch_number} into {db_path}", color="green")
+    os.makedirs(db_path, exist_ok=True)
+    with indent(4, quote=' >'):
+        with db.worker_pool(cores) as p:
+            results = p.starmap(import_caller_file, [(index, input_vcf, db_path, caller, batch_number, chunk_size, reader, region, clobber, debug) for index, input_vcf in enumerate(input_vcfs)])
+    summary = pd.DataFrame(results, columns=['vcf', 'db', 'rows', 'seconds', 'error', 'skipped'])
+    summary_file = os.path.join(db_path, f"{caller}.batch-{batch_number}.summary.tsv")
+    summary.to_csv(summary_file, sep='\t', index=False, float_format='%.2f')
+    failed = summary[summary['error'].notnull()]
+    skipped = summary['skipped'].sum()
+    log.logit(f"Imported {len(summary) - len(failed) - skipped} VCFs and skipped {skipped} already imported, with {summary['rows'].sum()} variants in {summary['seconds'].sum():.2f} seconds, see: {summary_file}")
+    for row in failed.itertuples():
+        log.logit(f"FAILED: {row.vcf} - {row.error}", color="red")
+    return summary
 
 #! DEPRECATED
 # This is the merging using *.db - For merging using *.parquet, see below
@@ -335,6 +421,7 @@ def prepare_parquet_files(index, file, caller, sample_ids, sample_db, variant_db
     check = False
     log.logit(f"Processing: {index} - {file}")
     sample_caller_connection = db.duckdb_connect_rw(file, False)
+    db.ensure_vkey(sample_caller_connection, caller)
     #sample_caller_connection.execute(f"ALTER TABLE {caller} ALTER COLUMN variant_id TYPE BIGINT")
     log.logit(f"Adding Sample IDs to {caller} database")
     samples.insert_sample_id_into_db(sample_caller_connection, caller, sample_db, False)
@@ -348,22 +435,21 @@ def prepare_parquet_files(index, file, caller, sample_ids, sample_db, variant_db
         log.logit(f"These samples: {existing_sample_ids} already exists in {caller}, need check")
         # Write a DuckDB table back to a Parquet file
         parquetPath = check_folder + os.path.basename(file).replace(".db", ".parquet")
-        sample_caller_connection.execute(f"COPY {caller} TO '{parquetPath}' (FORMAT 'parquet')") 
+        rows = sample_caller_connection.execute(f"COPY {caller} TO '{parquetPath}' (FORMAT 'parquet')").fetchone()[0]
         check = True
     else:
         # Create link to unsafe folder
         log.logit(f"These samples: {sample_ids_block} do not exist in {caller}, no check")
         # Write a DuckDB table back to a Parquet file
         parquetPath = no_check_folder + os.path.basename(file).replace(".db", ".parquet")
-        sample_caller_connection.execute(f"COPY {caller} TO '{parquetPath}' (FORMAT 'parquet')")
+        rows = sample_caller_connection.execute(f"COPY {caller} TO '{parquetPath}' (FORMAT 'parquet')").fetchone()[0]
         #sample_ids.extend(sample_ids_block)
     sample_caller_connection.close()
-    return check
+    # The signature is taken after the IDs were written, so it matches the file as it is left behind
+    return check, db.file_signature(file, rows)
 
 #def put_parquet_file_into_db_with_id_check(db_folder, db_name, parquet_folder, clobber):
 def merge_caller_tables(db_path, caller_connection, variant_db, sample_db, batch_number, caller, cores, debug):
-    # Setting memory_limit
-    caller_connection.execute("PRAGMA memory_limit='16GB'")
 
     # Getting all sample names from the caller table
     sql = f"""
@@ -373,48 +459,62 @@ def merge_caller_tables(db_path, caller_connection, variant_db, sample_db, batch
     caller_connection.execute(sql)
     sample_ids = caller_connection.df()["sample_id"].tolist()
 
-    # Create no_check and check merge folders within the db_path
+    # Only the files that are not in the merge manifest yet, or have changed since, are merged
+    db.ensure_merge_manifest(caller_connection)
+    files = db.unmerged_files(caller_connection, glob.glob(db_path + "/" + "*.db"))
+    if len(files) == 0:
+        log.logit(f"There are no new sample databases inside {db_path}", color="yellow")
+        return
+
+    # Create no_check and check merge folders within the db_path, throwing away anything left by a merge that did not finish
     check_folder = f"{db_path}/check/"
-    os.makedirs(check_folder, exist_ok=True)
-    check_count = 0
     no_check_folder = f"{db_path}/no_check/"
-    os.makedirs(no_check_folder, exist_ok=True)
+    for folder in [check_folder, no_check_folder]:
+        if os.path.exists(folder): shutil.rmtree(folder)
+        os.makedirs(folder)
+    check_count = 0
     no_check_count = 0
 
     # Prior to importing all parquet files, we need to insert variant_id and sample_id
+    # The variant index is made current once here so the workers only have to map it
+    variants.load_variant_index(variant_db)
     log.logit(f"Creating temporary DuckDB to insert variant_id and sample_id into parquet files")
     with indent(4, quote=' >'):
-        with mp.Pool(cores) as p:
-            check = p.starmap(prepare_parquet_files, [(index, db_file, caller, sample_ids, sample_db, variant_db, check_folder, no_check_folder) for index, db_file in enumerate(glob.glob(db_path + "/" + "*.db"))])
+        with db.worker_pool(cores) as p:
+            prepared = p.starmap(prepare_parquet_files, [(index, db_file, caller, sample_ids, sample_db, variant_db, check_folder, no_check_folder) for index, db_file in enumerate(files)])
+    check = [c for c, signature in prepared]
     # The multiprocessing will return either True or False depending on it needs to check or not.
     check_count = check.count(True)             # Number of files need to be checked
     no_check_count = check.count(False)         # Number of files that don't need to be checked and can perform unsafe merge            
     log.logit(f"Finished creating check and no_check folders, check: {check_count}, no_check: {no_check_count}")
 
-    # Insert no_check folder
+    # Both folders and the manifest are written in one transaction, so a failed merge leaves no trace
+    caller_connection.execute("BEGIN TRANSACTION")
+
+    # Insert no_check folder, each insert sorted by vkey so the row groups cover narrow ranges of the genome
     if no_check_count > 0:
         log.logit(f"Inserting {no_check_count} files into {caller}")
-        sql = f"INSERT INTO {caller} SELECT * FROM read_parquet('{no_check_folder}*.parquet')"
+        sql = f"INSERT INTO {caller} BY NAME SELECT * FROM read_parquet('{no_check_folder}*.parquet') ORDER BY vkey"
         caller_connection.execute(sql)
 
-    for i, file in enumerate(glob.glob(check_folder + "*.parquet")):
-        log.logit(f"Using safe merge for file number: {i} - {file}")
-        sql = f"""
-            SELECT DISTINCT sample_id
-            FROM read_parquet('{file}')
-        """
-        sample_id = caller_connection.execute(sql).df()["sample_id"].tolist()[0]       
+    # Insert check folder, all files at once, leaving out every (sample_id, variant_id) already in the table and keeping
+    # the first file's row when several files have the same one
+    if check_count > 0:
+        log.logit(f"Using safe merge for {check_count} files into {caller}")
         sql = f"""
-            INSERT INTO {caller} 
-            SELECT * FROM read_parquet('{file}') 
-            WHERE variant_id NOT IN (
-                SELECT c.variant_id 
-                FROM {caller} c 
-                WHERE c.sample_id = '{sample_id}'
-            )
+            INSERT INTO {caller} BY NAME
+            SELECT s.* EXCLUDE (filename)
+            FROM read_parquet('{check_folder}*.parquet', filename = true) s
+            ANTI JOIN {caller} c ON s.sample_id = c.sample_id AND s.variant_id = c.variant_id
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY s.sample_id, s.variant_id ORDER BY s.filename) = 1
+            ORDER BY s.vkey
         """
+        if debug: log.logit(f"Executing: {sql}")
         caller_connection.execute(sql)
 
+    db.record_merged_files(caller_connection, [signature for c, signature in prepared], batch_number)
+    caller_connection.execute("COMMIT")
+
     total = caller_connection.execute(f"SELECT COUNT(*) FROM {caller}").fetchall()[0][0]
     caller_connection.close()
     # Remove check and no_check folders
@@ -431,7 +531,10 @@ def insert_caller_batch(db_path, caller_db, variant_db, sample_db, caller, batch
     log.logit(f"Finished inserting variants")
     log.logit(f"All Done!", color="green")
 
-def annotate_fisher_test(pileup_db, caller_db, caller, batch_number, by_chromosome, debug):
+# Each chromosome is tested by its own worker, which reads the caller and pileup databases read-only and writes its
+# p-values to a parquet file in a job folder of its own, so runs in the same directory do not share any scratch files.
+# The caller table is then updated from all of the files at once
+def annotate_fisher_test(pileup_db, caller_db, caller, batch_number, by_chromosome, cache, cache_size, threshold, band, logfac_cache, cores, debug):
     if by_chromosome:
         chromosome = ['chr1', 'chr2', 'chr3', 'chr4', 'chr5', 'chr6', 'chr7', 'chr8', 'chr9', 'chr10', 
                'chr11', 'chr12', 'chr13', 'chr14', 'chr15', 'chr16', 'chr17', 'chr18', 'chr19', 'chr20', 
@@ -440,61 +543,86 @@ def annotate_fisher_test(pileup_db, caller_db, caller, batch_number, by_chromoso
         chromosome = ['ALL Chromosomes']
     log.logit(f"Performing the Fisher's Exact Test on the variants inside {caller_db} for batch: {batch_number}")
     caller = "mutect" if caller.lower() == "mutect" else "vardict"
-    temp_connection = db.duckdb_connect_rw("temp_fishers.db", False)
-    log.logit(f"Finding all variants within {caller_db} that does not have the fisher's exact test p-value calculated for batch: {batch_number}")
-    temp_connection.execute("PRAGMA memory_limit='16GB'")
-    temp_connection.execute(f"ATTACH '{pileup_db}' as pileup (READ_ONLY)")
-    temp_connection.execute(f"ATTACH '{caller_db}' as caller_db (READ_ONLY)")
-    for chrom in chromosome:
-        log.logit(f"Processing {chrom}")
-        if by_chromosome:
-            filter_string = f"c.key LIKE '{chrom}:%'"
-        else:
-            filter_string = "TRUE"
-        sql = f'''
-            CREATE TABLE fisher_variants AS
-            SELECT c.variant_id, c.sample_id, v.PoN_RefDepth, v.PoN_AltDepth, c.format_ref_fwd, c.format_ref_rev, c.format_alt_fwd, c.format_alt_rev
-            FROM caller_db.{caller} c LEFT JOIN pileup.pileup v
-            ON c.variant_id = v.variant_id
-            WHERE c.fisher_p_value is NULL AND
-                PoN_RefDepth is NOT NULL AND
-                PoN_AltDepth is NOT NULL AND
-                c.batch = {batch_number} AND
-                {filter_string};
-            
-            SELECT * 
-            FROM fisher_variants;
-        '''
-        if debug: log.logit(f"Executing: {sql}")
-        df = temp_connection.execute(sql).df()
-        temp_connection.execute(f"DROP TABLE fisher_variants;")
-        if debug: log.logit(f"SQL Complete")
-        length = len(df)
-        log.logit(f"There were {length} variants without fisher test p-value within {caller_db}")
-        if length > 0:
-            log.logit(f"Calculating Fisher Exact Test for all variants inside {caller_db}")
-            df = fisher_test.pvalue_df(df)
+    job_dir = tempfile.mkdtemp(prefix="fishers.", dir=os.path.dirname(os.path.abspath(caller_db)))
+    try:
+        with db.worker_pool(min(cores, len(chromosome))) as p:
+            results = p.starmap(fisher_test_chromosome, [(pileup_db, caller_db, caller, batch_number, chrom if by_chromosome else None, job_dir, cache, cache_size, threshold, band, logfac_cache, debug) for chrom in chromosome])
+        total = sum(results)
+        if total > 0:
+            log.logit(f"Updating {caller_db} with the fisher's exact test p-values of {total} variants")
             caller_connection = db.duckdb_connect_rw(f"{caller_db}", False)
-            log.logit(f"Updating {caller_db} with the fisher's exact test p-values")
+            ensure_fisher_exact(caller_connection, caller)
             sql = f"""
                 UPDATE {caller} as c
-                SET fisher_p_value = df.pvalue
-                FROM df
-                WHERE c.variant_id = df.variant_id AND c.sample_id = df.sample_id
+                SET fisher_p_value = r.pvalue, fisher_exact = r.exact
+                FROM read_parquet('{job_dir}/*.parquet') r
+                WHERE c.variant_id = r.variant_id AND c.sample_id = r.sample_id
             """
-            caller_connection.sql(sql)
+            if debug: log.logit(f"Executing: {sql}")
+            caller_connection.execute(sql)
             caller_connection.close()
         else:
             log.logit(f"There are no variants needed to update within {caller_db}")
-    temp_connection.close()
-    os.remove(f"temp_fishers.db")
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
     log.logit(f"Finished updating fisher test p-values inside {caller_db}")
     log.logit(f"Done!", color = "green")
 
+def fisher_test_chromosome(pileup_db, caller_db, caller, batch_number, chrom, job_dir, cache, cache_size, threshold, band, logfac_cache, debug):
+    log.logit(f"Processing {chrom or 'ALL Chromosomes'}")
+    fisher_test.set_logfac_cache(logfac_cache)
+    fisher_test.set_threads(db.connection_settings()['threads'])
+    if chrom:
+        filter_string = db.chrom_filter(chrom, "c")
+    else:
+        filter_string = "TRUE"
+    connection = db.duckdb_connect(":memory:")
+    db.duckdb_attach(connection, pileup_db, "pileup")
+    db.duckdb_attach(connection, caller_db, "caller_db")
+    sql = f'''
+        SELECT c.variant_id, c.sample_id, v.PoN_RefDepth, v.PoN_AltDepth, c.format_ref_fwd, c.format_ref_rev, c.format_alt_fwd, c.format_alt_rev
+        FROM caller_db.{caller} c LEFT JOIN pileup.pileup v
+        ON c.variant_id = v.variant_id
+        WHERE c.fisher_p_value is NULL AND
+            PoN_RefDepth is NOT NULL AND
+            PoN_AltDepth is NOT NULL AND
+            c.batch = {batch_number} AND
+            {filter_string}
+    '''
+    result_file = f"{job_dir}/{chrom or 'all'}.parquet"
+    if cache is None and threshold is None:
+        # Every p-value is exact and computed on its own, so DuckDB streams the rows through fisher_exact_test.
+        # The rows are gathered into a temporary table first, DuckDB 1.0 can hang running Python functions directly
+        # over the join of the attached databases
+        fisher_test.create_fisher_function(connection)
+        connection.execute(f"CREATE TEMP TABLE fisher_variants AS {sql}")
+        sql = f'''
+            COPY (
+                SELECT variant_id, sample_id,
+                    fisher_exact_test(PoN_RefDepth, PoN_AltDepth, format_ref_fwd + format_ref_rev, format_alt_fwd + format_alt_rev) AS pvalue,
+                    TRUE AS exact
+                FROM fisher_variants
+            ) TO '{result_file}' (FORMAT 'parquet')
+        '''
+        if debug: log.logit(f"Executing: {sql}")
+        length = connection.execute(sql).fetchall()[0][0]
+        if length == 0: os.remove(result_file)
+    else:
+        if debug: log.logit(f"Executing: {sql}")
+        df = connection.execute(sql).df()
+        length = len(df)
+        if length > 0:
+            df = fisher_test.pvalue_df(df, cache, cache_size, threshold, band)
+            result = df[['variant_id', 'sample_id', 'pvalue', 'exact']]
+            connection.execute(f"COPY result TO '{result_file}' (FORMAT 'parquet')")
+    if debug: log.logit(f"SQL Complete")
+    log.logit(f"Calculated the fisher test p-value of {length} variants within {caller_db} for {chrom or 'ALL Chromosomes'}")
+    connection.close()
+    return length
+
 def recalculate_bcbio_parameters(vardict_db, low_depth_for_allele_frequency, debug):
     log.logit(f"Calculating the BCBIO filter parameters for {vardict_db}", color="green")
     vardict_connection = db.duckdb_connect_ro(vardict_db)
-    vardict_connection.execute("PRAGMA memory_limit='16GB'")
     if debug: log.logit(f"Grabbing the FMT/AF, FMT/DP, and INFO/QUAL from Vardict")
     df = vardict_connection.execute(f"SELECT format_af, format_dp, info_qual FROM vardict LIMIT 20000000;").df()
     vardict_connection.close()
@@ -516,12 +644,11 @@ def bcbio_filter(vardict_db, low_depth_for_allele_frequency, total_depth, mean_q
         chromosome = ['ALL Chromosomes']
     log.logit(f"Filtering regions with low coverage for allele frequencies within {vardict_db} for batch: {batch_number}")
     temp_connection = db.duckdb_connect_rw("temp_bcbio.db", False)
-    temp_connection.execute("PRAGMA memory_limit='16GB'")
-    temp_connection.execute(f"ATTACH '{vardict_db}' as vardict_db (READ_ONLY)")
+    db.duckdb_attach(temp_connection, vardict_db, "vardict_db")
     for chrom in chromosome:
         log.logit(f"Processing {chrom}")
         if by_chromosome:
-            filter_string = f"c.key LIKE '{chrom}:%'"
+            filter_string = db.chrom_filter(chrom, "v")
         else:
             filter_string = "TRUE"
         sql = f"""
@@ -574,25 +701,24 @@ def caller_to_chromosome(caller_db, caller, batch_number, chrom, base_db, debug)
     caller = "mutect" if caller.lower() == "mutect" else "vardict"
     log.logit(f"Processing {chrom}...")
     chromosome_connection = db.duckdb_connect_rw(f"{base_db}.{chrom}.db", True)
-    chromosome_connection.execute("PRAGMA memory_limit='16GB'")
-    chromosome_connection.execute(f"ATTACH '{caller_db}' as caller (READ_ONLY)")
+    db.duckdb_attach(chromosome_connection, caller_db, "caller_src", chrom, batch_number)
     sql = f"""
             SELECT *
-            FROM caller.{caller} c
-            WHERE key LIKE '{chrom}:%'
+            FROM caller_src.{caller} c
+            WHERE {db.chrom_filter(chrom)}
         """
     if batch_number is not None:
         sql = sql + f" AND batch = {batch_number}"
     log.logit(f"Writing out variants to {base_db}.{chrom}.db")
-    chromosome_connection.execute(f"CREATE TABLE {caller} AS {sql}")
-    chromosome_connection.execute("DETACH caller")
+    # The table is created from its definition, since the filter ENUMs come back as plain strings from a dataset
+    setup_caller_tbl(chromosome_connection, caller)
+    chromosome_connection.execute(f"INSERT INTO {caller} BY NAME {sql}")
+    db.duckdb_detach(chromosome_connection, "caller_src")
     chromosome_connection.close()
     log.logit(f"Finished processing {caller_db}")
     log.logit(f"Done!", color = "green")
 
 def merge_chromosomes(chr_path, caller_connection, caller, debug):
-    # Setting memory_limit
-    caller_connection.execute("PRAGMA memory_limit='16GB'")
     log.logit(f"Creating parquet files")
     with indent(4, quote=' >'):
         for i, file in enumerate(glob.glob(chr_path + "/" + "*.chr*.db")):
@@ -603,17 +729,30 @@ def merge_chromosomes(chr_path, caller_connection, caller, debug):
             chromosome_connection.close()
     log.logit(f"Finished creating parquet files for all chromosomes in {chr_path}")
     log.logit(f"Inserting chromosome files into {caller}")
-    sql = f"INSERT INTO {caller} SELECT * FROM read_parquet('*.parquet')"
+    sql = f"INSERT INTO {caller} BY NAME SELECT * FROM read_parquet('*.parquet') ORDER BY vkey_of(key)"
     caller_connection.execute(sql)
+    db.ensure_vkey(caller_connection, caller)
     total = caller_connection.execute(f"SELECT COUNT(*) FROM {caller}").fetchall()[0][0]
     caller_connection.close()
     log.logit(f"Finished inserting {total} VCF rows into {caller}")
 
+# A Parquet dataset is already split by chromosome, so it is read back in a single pass over its partitions
+def dataset_to_caller(dataset, caller_connection, caller, debug):
+    sql = f"INSERT INTO {caller} BY NAME {db.dataset_scan(dataset, caller)} ORDER BY vkey_of(key)"
+    if debug: log.logit(f"Executing: {sql}")
+    caller_connection.execute(sql)
+    db.ensure_vkey(caller_connection, caller)
+    total = caller_connection.execute(f"SELECT COUNT(*) FROM {caller}").fetchall()[0][0]
+    log.logit(f"Finished inserting {total} VCF rows into {caller}")
+
 def chromosome_to_caller(chr_path, caller_db, caller, debug):
     log.logit(f"Inserting chromosomes from {chr_path} into {caller_db}", color="green")
     caller_connection = db.duckdb_connect_rw(caller_db, True)
     setup_caller_tbl(caller_connection, caller)
-    merge_chromosomes(chr_path, caller_connection, caller, debug)
+    if os.path.isdir(f"{chr_path}/{caller}"):
+        dataset_to_caller(chr_path, caller_connection, caller, debug)
+    else:
+        merge_chromosomes(chr_path, caller_connection, caller, debug)
     caller_connection.close()
     log.logit(f"Finished inserting variants")
     log.logit(f"All Done!", color="green")
\ No newline at end of file
@@ -1,9 +1,12 @@
-import os, csv, glob
+import os, csv, glob, shutil
 import duckdb
+import numpy as np
+import pandas as pd
 
 import ch.vdbtools.handlers.vcf as vcf
 import ch.utils.logger as log
 import ch.utils.database as db
+import ch.utils.files as files
 from clint.textui import indent, puts_err, puts
 
 def ensure_variants_table(connection):
@@ -19,16 +22,20 @@ def ensure_variants_table(connection):
             batch                  INTEGER,
             start                  INTEGER,
             stop                   INTEGER,
-            key                    VARCHAR NOT NULL
+            key                    VARCHAR NOT NULL,
+            vkey                   BIGINT
         )
     """
     connection.execute(sql)
+    # Variants registered before vkey existed get it filled in from their key
+    connection.execute("ALTER TABLE variants ADD COLUMN IF NOT EXISTS vkey BIGINT")
+    connection.execute("UPDATE variants SET vkey = vkey_of(key) WHERE vkey is NULL")
 
 def ensure_pileup_table(connection):
     log.logit("Ensuring or creating the pileup table")
     sql = """
         CREATE TABLE IF NOT EXISTS pileup(
-            key                    VARCHAR NOT NULL,
+            vkey                   BIGINT NOT NULL,
             PoN_RefDepth           INTEGER,
             PoN_AltDepth           INTEGER,
             batch                  INTEGER,
@@ -36,93 +43,218 @@ def ensure_pileup_table(connection):
         )
     """
     connection.execute(sql)
+    # Pileup tables from before vkey existed have their VARCHAR key replaced by vkey
+    columns = connection.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'pileup'").df()['column_name'].tolist()
+    if 'key' in columns:
+        log.logit("Replacing the key column of the pileup table with vkey")
+        connection.execute("ALTER TABLE pileup ADD COLUMN vkey BIGINT")
+        connection.execute("UPDATE pileup SET vkey = vkey_of(key)")
+        connection.execute("ALTER TABLE pileup DROP COLUMN key")
+
+# The variant_id sequence only ever moves forward, so an ID handed out once is never given to another variant,
+# even after variants are removed, the database is rebuilt or split up by chromosome
+def ensure_variant_id_sequence(connection):
+    connection.execute("CREATE TABLE IF NOT EXISTS variant_id_sequence(last_variant_id BIGINT NOT NULL)")
+    if connection.execute("SELECT count(*) FROM variant_id_sequence").fetchone()[0] == 0:
+        # Databases from before the sequence existed continue from their highest variant_id
+        connection.execute("INSERT INTO variant_id_sequence SELECT coalesce(max(variant_id), 0) FROM variants")
+
+def last_variant_id(connection):
+    return connection.execute("SELECT last_variant_id FROM variant_id_sequence").fetchone()[0]
+
+def advance_variant_id_sequence(connection):
+    connection.execute("UPDATE variant_id_sequence SET last_variant_id = (SELECT greatest(max(variant_id), last_variant_id) FROM variants)")
+
+# Only the vkeys with hashed alleles can collide, so only those are compared across the variants already in the database
+# and the incoming ones. Two different keys sharing a vkey would silently merge two variants, so stop instead
+def check_vkey_collisions(connection, source):
+    sql = f"""
+        WITH s AS (
+            SELECT vkey, key FROM {source} WHERE vkey_hashed(vkey)
+        ),
+        c AS (
+            SELECT vkey, key FROM variants WHERE vkey_hashed(vkey)
+            UNION
+            SELECT vkey, key FROM s
+        )
+        SELECT min(key), max(key)
+        FROM c
+        GROUP BY vkey
+        HAVING count(*) > 1
+        LIMIT 1
+    """
+    collision = connection.execute(sql).fetchall()
+    if collision:
+        msg = f"The variants {collision[0][0]} and {collision[0][1]} have the same vkey"
+        log.logit(msg, color="red")
+        raise ValueError(msg)
+
+# Parallelize copying out each sample's variants as a Parquet File, tagged with the file and row order so the merge
+# keeps the same first occurrence of each variant as merging the files one after another would
+def export_variants_parquet(index, file, parquet_folder):
+    log.logit(f"Exporting: {index} - {file}")
+    sample_connection = db.duckdb_connect_ro(file)
+    parquetPath = parquet_folder + os.path.basename(file).replace(".db", ".parquet")
+    rows = sample_connection.execute(f"COPY (SELECT *, {index} AS file_index, ROWID AS row_order FROM variants) TO '{parquetPath}' (FORMAT 'parquet')").fetchone()[0]
+    sample_connection.close()
+    return db.file_signature(file, rows)
 
-def merge_variants_tables(db_path, connection, batch_number, debug):
-    log.logit(f'Merging Sample Variants from {db_path} using the variant key')
-    connection.execute("PRAGMA memory_limit='16GB'")
+# All sample variants are read as one scan over the exported Parquet files and deduplicated against the variants table
+# and each other in a single statement, so the merge is linear in the number of input rows. New variants get the next
+# IDs from the variant_id sequence while they are inserted, existing variants keep theirs. Files already in the merge
+# manifest are skipped, so a failed or extended batch can simply be merged again
+def merge_variants_tables(db_path, connection, batch_number, cores, debug):
+    log.logit(f'Merging Sample Variants from {db_path} using the variant vkey')
+    db.ensure_merge_manifest(connection)
+    files = db.unmerged_files(connection, glob.glob(db_path + "/" + "*.db"))
+    if len(files) == 0:
+        log.logit(f"There are no new sample databases inside {db_path}", color="yellow")
+        return
+    # Anything left behind by a merge that did not finish is thrown away
+    parquet_folder = f"{db_path}/parquet/"
+    if os.path.exists(parquet_folder): shutil.rmtree(parquet_folder)
+    os.makedirs(parquet_folder)
+    log.logit(f"Exporting {len(files)} sample databases to Parquet")
     with indent(4, quote=' >'):
-        for i, file in enumerate(glob.glob(db_path + "/" + "*.db")):
-            sample_name = os.path.basename(file).split('.')[1]
-            log.logit(f"Merging: {i} - {file}")
-            connection.execute(f"ATTACH \'{file}\' as sample_{i} (READ_ONLY)")
-            sql = f"""
-                INSERT INTO variants SELECT s.*
-                FROM sample_{i}.variants s
-                WHERE s.key NOT IN (
-                    SELECT key
-                    FROM variants v
-                    WHERE v.key IN (
-                        SELECT key
-                        FROM sample_{i}.variants
-                    )
-                )
-            """
-            connection.sql(sql)
-            connection.execute(f"DETACH sample_{i}")
-    log.logit(f"Finished merging all tables from: {db_path}")
-
-def insert_variant_batch(db_path, variant_db, batch_number, debug, clobber):
+        with db.worker_pool(cores) as p:
+            signatures = p.starmap(export_variants_parquet, [(index, file, parquet_folder) for index, file in enumerate(files)])
+    samples = f"read_parquet('{parquet_folder}*.parquet')"
+    check_vkey_collisions(connection, samples)
+    sql = f"""
+        INSERT INTO variants BY NAME
+        SELECT * EXCLUDE (file_index, row_order) REPLACE ({last_variant_id(connection)} + ROW_NUMBER() OVER (ORDER BY file_index, row_order) AS variant_id)
+        FROM (
+            SELECT s.*
+            FROM {samples} s
+            ANTI JOIN variants v ON s.vkey = v.vkey
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY s.vkey ORDER BY s.file_index, s.row_order) = 1
+        )
+        ORDER BY file_index, row_order
+    """
+    if debug: log.logit(f"Executing: {sql}")
+    connection.execute("BEGIN TRANSACTION")
+    total = connection.execute(sql).fetchone()[0]
+    advance_variant_id_sequence(connection)
+    db.record_merged_files(connection, signatures, batch_number)
+    connection.execute("COMMIT")
+    shutil.rmtree(parquet_folder)
+    log.logit(f"Finished merging all tables from: {db_path}, {total} new variants")
+
+def insert_variant_batch(db_path, variant_db, batch_number, cores, debug, clobber):
     log.logit(f"Inserting variants from batch: {batch_number} into {variant_db}", color="green")
     connection = db.duckdb_connect_rw(variant_db, clobber)
     ensure_variants_table(connection)
     connection.execute("ALTER TABLE variants ADD COLUMN IF NOT EXISTS variant_id BIGINT")
-    merge_variants_tables(db_path, connection, batch_number, debug)
-    connection.execute("UPDATE variants SET variant_id = ROWID + 1 WHERE variant_id is NULL")
+    ensure_variant_id_sequence(connection)
+    # Variants left without an ID by older versions are numbered from the sequence in the order they were inserted
+    connection.execute(f"""
+        UPDATE variants SET variant_id = n.variant_id
+        FROM (SELECT ROWID AS row_order, {last_variant_id(connection)} + ROW_NUMBER() OVER (ORDER BY ROWID) AS variant_id FROM variants WHERE variant_id is NULL) n
+        WHERE variants.ROWID = n.row_order
+    """)
+    advance_variant_id_sequence(connection)
+    merge_variants_tables(db_path, connection, batch_number, cores, debug)
     connection.close()
+    build_variant_index(variant_db)
     log.logit(f"Finished inserting variants")
     log.logit(f"All Done!", color="green")
 
-def import_sample_variants(input_vcf, variant_db, batch_number, debug, clobber):
+def import_sample_variants(input_vcf, variant_db, batch_number, engine, debug, clobber):
     log.logit(f"Registering variants from file: {input_vcf}", color="green")
     connection = db.duckdb_connect_rw(variant_db, clobber)
     ensure_variants_table(connection)
-    counts, df = vcf.vcf_to_pd(input_vcf, "variants", batch_number, debug)
     connection.execute("ALTER TABLE variants ADD COLUMN IF NOT EXISTS variant_id BIGINT")
-    df = df.drop_duplicates(subset='key', keep='first')
-    vcf.duckdb_load_df_file(connection, df, "variants")
+    if engine == "duckdb":
+        counts = vcf.variants_to_duckdb(connection, input_vcf, "variants", batch_number, debug)
+    else:
+        counts, df = vcf.vcf_to_pd(input_vcf, "variants", batch_number, debug)
+        df = df.drop_duplicates(subset='key', keep='first').rename(columns={'end': 'stop'})
+        connection.execute("INSERT INTO variants BY NAME SELECT *, vkey(chrom, pos, ref, alt) AS vkey FROM df")
     connection.close()
     log.logit(f"Finished registering variants")
     log.logit(f"Variants Processed - Total: {counts}", color="green")
     log.logit(f"All Done!", color="green")
 
-def insert_variant_id_into_df(df, connection, debug):
-    log.logit(f"Inserting variant_id for all variants")
-    connection.execute("PRAGMA memory_limit='16GB'")
-    sql = f"""
-            SELECT variant_id, key
-            FROM variants v
-            WHERE v.key IN (
-                SELECT key
-                FROM df
-            )
-    """
-    if debug: log.logit(f"Executing: {sql}")
-    v = connection.execute(sql).df()
-    if debug: log.logit(f"SQL Complete")
-    df = v.merge(df, on='key', how='left')
-    df = df.drop('key', axis=1)
-    return df
+# The variant index is every vkey in the variants table sorted, stacked on top of their variant_id, saved as a single
+# NumPy file next to the variant database. It is memory-mapped read-only, so all the worker processes resolving IDs
+# share one copy through the page cache, and millions of vkeys are looked up at once with a binary search
+def variant_index_path(variant_db):
+    return f"{variant_db}.vidx.npy"
+
+def build_variant_index(variant_db):
+    log.logit(f"Building the variant index for {variant_db}")
+    connection = db.duckdb_connect(":memory:")
+    db.duckdb_attach(connection, variant_db, "variant")
+    index = connection.execute("SELECT vkey, variant_id FROM variant.variants WHERE variant_id is NOT NULL ORDER BY vkey").arrow()
+    connection.close()
+    index = np.stack([index['vkey'].to_numpy(), index['variant_id'].to_numpy()]).astype(np.int64)
+    # Written atomically so readers never see a partial index
+    with files.atomic_write(variant_index_path(variant_db)) as f:
+        np.save(f, index)
+    log.logit(f"Finished building the variant index: {index.shape[1]} variants")
+
+variant_indexes = {}
 
+# Rebuilt whenever the variant database was written to after the index was, otherwise loaded once per process
+def load_variant_index(variant_db):
+    path = variant_index_path(variant_db)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(variant_db):
+        variant_indexes.pop(variant_db, None)
+        build_variant_index(variant_db)
+    if variant_db not in variant_indexes:
+        variant_indexes[variant_db] = np.load(path, mmap_mode='r')
+    return variant_indexes[variant_db]
+
+# Returns the variant_id of each vkey, or NA when the vkey is not in the index
+def lookup_variant_ids(index, vkeys):
+    vkeys = np.asarray(vkeys, dtype=np.int64)
+    positions = np.searchsorted(index[0], vkeys)
+    found = positions < index.shape[1]
+    found[found] = index[0][positions[found]] == vkeys[found]
+    variant_ids = np.zeros(len(vkeys), dtype=np.int64)
+    variant_ids[found] = index[1][positions[found]]
+    return pd.arrays.IntegerArray(variant_ids, ~found)
+
+def vkeys_of(keys):
+    connection = db.configure_connection(duckdb.connect())
+    db.create_vkey_macros(connection)
+    keys = pd.DataFrame({'key': keys})
+    vkeys = connection.execute("SELECT vkey_of(key) AS vkey FROM keys").arrow()['vkey'].to_numpy()
+    connection.close()
+    return vkeys
+
+# Only the distinct vkeys without an ID are looked up in the variant index, and the table is then updated from that
+# small mapping instead of joining it against the whole variant database
 def insert_variant_id_into_db(db, table, variant_db, debug, filter_string = True):
     log.logit(f"Inserting variant_id from {variant_db} for all {table} variants")
-    db.execute("PRAGMA memory_limit='16GB'")
-    db.execute(f"ATTACH \'{variant_db}\' as v (READ_ONLY)")
+    index = load_variant_index(variant_db)
+    # Tables with a stored vkey are joined on it, older ones compute it from their key
+    columns = db.execute(f"SELECT column_name FROM duckdb_columns() WHERE database_name = current_database() AND table_name = '{table}'").df()['column_name'].tolist()
+    vkey = f"{table}.vkey" if 'vkey' in columns else f"vkey_of({table}.key)"
+    sql = f"""
+        SELECT DISTINCT {vkey} AS vkey
+        FROM {table}
+        WHERE variant_id is NULL
+        AND {filter_string}
+    """
+    if debug: log.logit(f"Executing: {sql}")
+    ids = db.execute(sql).df()
+    ids['variant_id'] = lookup_variant_ids(index, ids['vkey'])
+    ids = ids[ids['variant_id'].notna()]
     sql = f"""
         UPDATE {table}
-        SET variant_id = v.variant_id
-        FROM v.variants v
-        WHERE {table}.key = v.key
+        SET variant_id = ids.variant_id
+        FROM ids
+        WHERE {vkey} = ids.vkey
         AND {table}.variant_id is NULL
         AND {filter_string};
     """
     if debug: log.logit(f"Executing: {sql}")
     db.execute(sql)
-    db.execute(f"DETACH v")
     if debug: log.logit(f"SQL Complete")
 
 def insert_variant_keys(df, connection, debug):
     log.logit(f"Inserting variant key for all variants")
-    connection.execute("PRAGMA memory_limit='16GB'")
     sql = f"""
             SELECT variant_id, key
             FROM variants v
@@ -172,74 +304,81 @@ def dump_variants_pileup(variant_db, pileup_db, header, batch_number, chromosome
         log.logit(f"Dumping batch: {batch_number} variants from: {variant_db} into a VCF file that needs pileup", color="green")
     else:
         log.logit(f"Dumping batch: {batch_number} and chromosome: {chromosome} variants from: {variant_db} into a VCF file that needs pileup", color="green")
-    variant_connection = db.duckdb_connect_ro(variant_db)
-    variant_connection.execute(f"ATTACH \'{pileup_db}\' as pileup (READ_ONLY)")
+    variant_connection = db.duckdb_connect(":memory:")
+    db.duckdb_attach(variant_connection, variant_db, "variant")
+    db.duckdb_attach(variant_connection, pileup_db, "pileup")
     sql = f"""
         SELECT variant_id, chrom, pos, ref, alt 
-        FROM variants 
+        FROM variant.variants 
         WHERE batch = {batch_number} AND 
-        variants.key NOT IN (
-            SELECT key
+        variants.vkey NOT IN (
+            SELECT vkey
             FROM pileup.pileup
         )
     """
     variants = variant_connection.sql(sql)
-    variant_connection.execute(f"DETACH pileup")
     vcf.variants_to_vcf(variants, header, batch_number, chromosome, debug)
+    db.duckdb_detach(variant_connection, "pileup")
     variant_connection.close()
     log.logit(f"Finished dumping variants that need pileup into VCF file")
     log.logit(f"All Done!", color="green")
 
-def import_pon_pileup(pileup_db, variant_db, pon_pileup, batch_number, debug, clobber):
+# The pileup is streamed in chunks of chunk_size records, so memory is bound by the chunk size, and the variant_id of
+# each chunk is looked up in the variant index (see load_variant_index) as it is inserted, instead of joining every
+# chunk against the whole variants table
+def import_pon_pileup(pileup_db, variant_db, pon_pileup, batch_number, chunk_size, reader, region, threads, debug, clobber):
     log.logit(f"Adding pileup from batch: {batch_number} into {pileup_db}", color="green")
     pileup_connection = db.duckdb_connect_rw(pileup_db, clobber)
     ensure_pileup_table(pileup_connection)
-    counts, df = vcf.vcf_to_pd(pon_pileup, "pileup", batch_number, debug)
-    vcf.duckdb_load_df_file(pileup_connection, df, "pileup")
-    if counts > 100_000_000:
-        for chrom in ['chr1', 'chr2', 'chr3', 'chr4', 'chr5', 'chr6', 'chr7', 'chr8', 'chr9', 'chr10', 
-               'chr11', 'chr12', 'chr13', 'chr14', 'chr15', 'chr16', 'chr17', 'chr18', 'chr19', 'chr20', 
-               'chr21', 'chr22', 'chrX', 'chrY']:
-            log.logit(f"Adding Variant IDs to the pileup database for: {chrom}")
-            insert_variant_id_into_db(pileup_connection, "pileup", variant_db, debug, f"pileup.key LIKE '{chrom}:%'")
-    else:
-        log.logit(f"Adding Variant IDs to the pileup database")
-        insert_variant_id_into_db(pileup_connection, "pileup", variant_db, debug)
+    index = load_variant_index(variant_db)
+    sql = "SELECT vkey(chrom, pos, ref, alt) AS vkey, PoN_RefDepth, PoN_AltDepth, batch FROM df"
+    counts = 0
+    with indent(4, quote=' >'):
+        for count, df in vcf.pileup_to_chunks(pon_pileup, batch_number, chunk_size, debug, reader, region, threads):
+            if debug: log.logit(f"Executing: {sql}")
+            chunk = pileup_connection.execute(sql).df()
+            chunk['variant_id'] = lookup_variant_ids(index, chunk['vkey'])
+            pileup_connection.execute("INSERT INTO pileup BY NAME SELECT * FROM chunk")
+            counts += count
+            log.logit(f"{counts} pileup variants loaded.")
     pileup_connection.close()
     log.logit(f"Finished importing pileup information")
     log.logit(f"Variants Processed - Total: {counts}", color="green")
     log.logit(f"All Done!", color="green")
 
+# The source is attached as {variant}_src, since DuckDB names the catalog of the output file after it, so
+# variant.chr1.db is already "variant" in this connection
 def variant_to_chromosome(variant_db, variant, chrom, base_db, debug):
     log.logit(f"Processing {chrom}...")
     chromosome_connection = db.duckdb_connect_rw(f"{base_db}.{chrom}.db", True)
-    chromosome_connection.execute("PRAGMA memory_limit='16GB'")
-    chromosome_connection.execute(f"ATTACH '{variant_db}' as {variant} (READ_ONLY)")
+    db.duckdb_attach(chromosome_connection, variant_db, f"{variant}_src", chrom)
     sql = f"""
             SELECT *
-            FROM {variant}.variants v
-            WHERE key LIKE '{chrom}:%'
+            FROM {variant}_src.variants v
+            WHERE {db.chrom_filter(chrom)}
         """
     log.logit(f"Writing out variants to {base_db}.{chrom}.db")
     chromosome_connection.execute(f"CREATE TABLE variants AS {sql}")
-    chromosome_connection.execute(f"DETACH {variant}")
+    db.duckdb_detach(chromosome_connection, f"{variant}_src")
     chromosome_connection.close()
     log.logit(f"Finished processing {variant_db}")
     log.logit(f"Done!", color = "green")
 
 def pileup_to_chromosome(pileup_db, pileup, chrom, base_db, debug):
+    # The pileup keeps only the vkey, which does not tell the contigs outside ch.utils.database.CONTIGS apart
+    if chrom not in db.CONTIGS:
+        raise ValueError(f"The pileup can only be split by {', '.join(db.CONTIGS)}, not {chrom}")
     log.logit(f"Processing {chrom}...")
     chromosome_connection = db.duckdb_connect_rw(f"{base_db}.{chrom}.db", True)
-    chromosome_connection.execute("PRAGMA memory_limit='16GB'")
-    chromosome_connection.execute(f"ATTACH '{pileup_db}' as {pileup} (READ_ONLY)")
+    db.duckdb_attach(chromosome_connection, pileup_db, f"{pileup}_src", chrom)
     sql = f"""
             SELECT *
-            FROM {pileup}.{pileup} p
-            WHERE key LIKE '{chrom}:%'
+            FROM {pileup}_src.{pileup} p
+            WHERE {db.chrom_filter(chrom)}
         """
     log.logit(f"Writing out variants to {base_db}.{chrom}.db")
     chromosome_connection.execute(f"CREATE TABLE {pileup} AS {sql}")
-    chromosome_connection.execute(f"DETACH {pileup}")
+    db.duckdb_detach(chromosome_connection, f"{pileup}_src")
     chromosome_connection.close()
     log.logit(f"Finished processing {pileup_db}")
     log.logit(f"Done!", color = "green")
\ No newline at end of file
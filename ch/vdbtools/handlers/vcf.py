@@ -1,15 +1,21 @@
 import collections
+import contextlib
 import pysam
-import os, io, gzip
+import os, io, gzip, json, hashlib
+from itertools import islice
 
 import importlib.resources
 import ch.utils.logger as log
+import ch.utils.files as files
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+from numba import njit
 
 from clint.textui import indent, puts_err, puts
 
 def duckdb_load_df_file(duckdb_connection, df, table):
-    duckdb_connection.execute("PRAGMA memory_limit='16GB'")
+    df = df_to_arrow(df, table_schema(duckdb_connection, table))
     sql = f"""
         INSERT INTO {table} SELECT * FROM df
     """
@@ -17,7 +23,47 @@ def duckdb_load_df_file(duckdb_connection, df, table):
     duckdb_connection.execute(sql)
     log.logit(f"Finished inserting pandas dataframe into duckdb")
 
-def vcf_to_pd(input_vcf, what_process, batch_number, debug):
+# DataFrames are handed to DuckDB as Arrow tables typed after the DuckDB table, so DuckDB neither converts python objects
+# value by value nor sniffs the column types. ENUMs are sent as strings and DECIMALs as doubles, DuckDB casts them on insert
+def wire_type(arrow_type):
+    if pa.types.is_dictionary(arrow_type):
+        return wire_type(arrow_type.value_type)
+    if pa.types.is_decimal(arrow_type):
+        return pa.float64()
+    if pa.types.is_list(arrow_type):
+        return pa.list_(wire_type(arrow_type.value_type))
+    return arrow_type
+
+def table_schema(duckdb_connection, table):
+    schema = duckdb_connection.execute(f"SELECT * FROM {table} LIMIT 0").arrow().schema
+    return pa.schema([pa.field(field.name, wire_type(field.type)) for field in schema])
+
+# Without a schema, i.e. when the DataFrame creates the table, object columns become strings the same way
+# pandas_analyze_sample=0 made them VARCHAR
+def df_to_arrow(df, schema=None):
+    if schema is None:
+        names = [str(column) for column in df.columns]
+        types = [pa.string() if dtype == object else None for dtype in df.dtypes]
+    elif len(schema) != df.shape[1]:
+        raise ValueError(f"The DataFrame has {df.shape[1]} columns but the table has {len(schema)}")
+    else:
+        names, types = schema.names, schema.types
+    arrays = [to_arrow_array(df.iloc[:, column], arrow_type) for column, arrow_type in enumerate(types)]
+    return pa.Table.from_arrays(arrays, names=names)
+
+def to_arrow_array(values, arrow_type):
+    try:
+        return pa.array(values, type=arrow_type, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+    if arrow_type is not None and pa.types.is_string(arrow_type):   # Mixed python objects, stored by their str()
+        return pa.array(np.where(values.isna(), None, values.astype(str)), type=pa.string())
+    try:
+        return pa.array(values, from_pandas=True)                   # Left for DuckDB to cast on insert, as before
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array(np.where(values.isna(), None, values.astype(str)), type=pa.string())
+
+def vcf_to_pd(input_vcf, what_process, batch_number, debug, reader="gzip", region=None, threads=1):
     log.logit(f"Processing: {input_vcf}")
     dispatch = {
         'variants'  : variants_to_df,
@@ -25,7 +71,51 @@ def vcf_to_pd(input_vcf, what_process, batch_number, debug):
         'pileup'    : pileup_to_df
     }
     function = dispatch[what_process]
-    return function(input_vcf, batch_number, debug)
+    if what_process == 'variants':
+        return function(input_vcf, batch_number, debug)
+    return function(input_vcf, batch_number, debug, reader, region, threads)
+
+# Yields the header lines and the records of the VCF, either through python's gzip or through htslib.
+# The htslib reader decompresses with multiple threads and, given a region e.g. chr1 or chr1:1000-2000, only reads the
+# records inside that region. This needs a bgzip compressed VCF with a tabix index.
+@contextlib.contextmanager
+def open_vcf(input_vcf, reader, region, threads):
+    if reader == "htslib":
+        log.logit(f"Reading {input_vcf} using htslib with {threads} threads" + (f" in the region {region}" if region else ""))
+        tabix = pysam.TabixFile(input_vcf, threads=threads)
+        try:
+            contig = region.split(':')[0] if region is not None else None
+            if contig is not None and contig not in tabix.contigs:
+                records = iter([])
+            else:
+                records = (record + '\n' for record in tabix.fetch(region=region))
+            yield list(tabix.header), records
+        finally:
+            tabix.close()
+    else:
+        if region is not None:
+            raise ValueError(f"Reading only the region {region} requires the htslib reader")
+        with gzip.open(input_vcf, 'rt') as f:
+            header = []
+            for line in f:
+                header.append(line)
+                if line.startswith('#CHROM'):
+                    break
+            yield header, f
+
+# Reads the records from open_vcf into DataFrames of chunk_size records, or a single DataFrame if chunk_size is None
+def read_vcf_records(records, chunk_size, **kwargs):
+    if hasattr(records, 'read'):
+        if chunk_size is None:
+            yield pd.read_csv(records, comment='#', sep='\t', header=None, **kwargs)
+        else:
+            yield from pd.read_csv(records, comment='#', sep='\t', header=None, chunksize=chunk_size, **kwargs)
+        return
+    while True:
+        lines = list(islice(records, chunk_size))
+        if not lines:
+            break
+        yield pd.read_csv(io.StringIO(''.join(lines)), comment='#', sep='\t', header=None, **kwargs)
 
 def variants_to_df(input_vcf, batch_number, debug):
     log.logit(f"Reading in the Variants VCF...")
@@ -49,98 +139,323 @@ def variants_to_df(input_vcf, batch_number, debug):
     total = len(res)
     return total, res
 
-def pileup_to_df(input_vcf, batch_number, debug):
+# Same as variants_to_df followed by duckdb_load_df_file, but the VCF is read by DuckDB's CSV reader and the derived
+# columns are computed in SQL, so nothing is materialized in pandas and the load runs on all of DuckDB's threads.
+# Duplicate keys keep the first record in file order, like drop_duplicates(keep='first')
+def variants_to_duckdb(duckdb_connection, input_vcf, table, batch_number, debug):
+    log.logit(f"Reading in the Variants VCF using DuckDB...")
+    with open_vcf(input_vcf, "gzip", None, 1) as (header, records):
+        columns = header[-1].lstrip('#').strip('\n').split('\t')
+    columns = ', '.join([f"'column{i}': '{'BIGINT' if i == 1 else 'VARCHAR'}'" for i in range(len(columns))])
+    sql = f"""
+        INSERT INTO {table} BY NAME
+        SELECT chrom, pos, ref, alt, snp, qc_pass, batch, start, stop, key, vkey(chrom, pos, ref, alt) AS vkey, variant_id
+        FROM (
+            SELECT column0 AS chrom,
+                   column1 AS pos,
+                   column3 AS ref,
+                   column4 AS alt,
+                   length(column3) = 1 AND length(column4) = 1 AS snp,
+                   NULL AS qc_pass,
+                   {batch_number} AS batch,
+                   column1 AS start,
+                   column1 + length(column4) AS stop,
+                   column0 || ':' || column1 || ':' || column3 || ':' || column4 AS key,
+                   NULL AS variant_id,
+                   ROW_NUMBER() OVER () AS row_order
+            FROM read_csv('{input_vcf}',
+                          compression='gzip',
+                          delim='\\t',
+                          quote='',
+                          escape='',
+                          header=false,
+                          auto_detect=false,
+                          skip={len(header)},
+                          columns={{{columns}}})
+        )
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY key ORDER BY row_order) = 1
+        ORDER BY row_order
+    """
+    if debug: log.logit(f"Executing: {sql}")
+    total = duckdb_connection.execute(sql).fetchone()[0]
+    log.logit(f"Finished reading in the variant VCF")
+    return total
+
+def pileup_to_df(input_vcf, batch_number, debug, reader="gzip", region=None, threads=1):
     log.logit(f"Reading in the Pileup VCF...")
-    chunksize = 100_000_000
-    chunks = []
-    for chunk in pd.read_csv(input_vcf,
-                             comment='#',
-                             compression='gzip',
-                             sep='\t',
-                             header=None,
-                             usecols=[0,1,3,4,7],
-                             chunksize=chunksize):
-        chunk = chunk.rename(columns={0: "chrom",
-                                      1: "pos",
-                                      3: "ref",
-                                      4: "alt",
-                                      7: "info"})
-        log.logit(f"Formatting the dataframe...")
-        chunk['key'] = chunk['chrom'] + ':' + chunk['pos'].astype(str) + ':' + chunk['ref'] + ':' + chunk['alt']
-        chunk[['PoN_RefDepth','PoN_AltDepth']] = chunk['info'].str.split(";", expand=True)
-        chunk['PoN_RefDepth'] = chunk['PoN_RefDepth'].str.split("=").str[1]
-        chunk['PoN_AltDepth'] = chunk['PoN_AltDepth'].str.split("=").str[1]
-        chunk['batch'] = batch_number
-        chunk['variant_id'] = None
-        chunk = chunk[['key', 'PoN_RefDepth', 'PoN_AltDepth', 'batch', 'variant_id']]
-        chunks.append(chunk)
+    chunks = [chunk for count, chunk in pileup_to_chunks(input_vcf, batch_number, 100_000_000, debug, reader, region, threads)]
     log.logit(f"Finished preparing the dataframe...")
-    res = pd.concat(chunks, ignore_index=True)
+    res = pa.concat_tables([PILEUP_SCHEMA.empty_table()] + chunks).to_pandas()
     total = len(res)
     return total, res
 
+PILEUP_SCHEMA = pa.schema([('chrom', pa.string()), ('pos', pa.int64()), ('ref', pa.string()), ('alt', pa.string()),
+                           ('PoN_RefDepth', pa.int32()), ('PoN_AltDepth', pa.int32()), ('batch', pa.int32()), ('variant_id', pa.int64())])
+
+# Yields the pileup in Arrow tables of chunk_size records. The INFO column holds PON_RefDepth=N;PON_AltDepth=N
+# and both depths are parsed straight into integers with a single regex pass
+def pileup_to_chunks(input_vcf, batch_number, chunk_size, debug, reader="gzip", region=None, threads=1):
+    log.logit(f"Reading in the Pileup VCF in chunks of {chunk_size} records...")
+    with open_vcf(input_vcf, reader, region, threads) as (header, records):
+        for chunk in read_vcf_records(records, chunk_size, usecols=[0,1,3,4,7]):
+            chunk = chunk.rename(columns={0: "chrom",
+                                          1: "pos",
+                                          3: "ref",
+                                          4: "alt",
+                                          7: "info"})
+            log.logit(f"Formatting the dataframe...")
+            depths = chunk['info'].str.extract(r'^[^=]*=(\d*);[^=]*=(\d*)$')
+            chunk['PoN_RefDepth'] = pd.to_numeric(depths[0]).astype('Int64')
+            chunk['PoN_AltDepth'] = pd.to_numeric(depths[1]).astype('Int64')
+            chunk['batch'] = batch_number
+            chunk['variant_id'] = None
+            chunk = pa.Table.from_pandas(chunk[PILEUP_SCHEMA.names], schema=PILEUP_SCHEMA, preserve_index=False)
+            yield chunk.num_rows, chunk
+
+VCF_TYPES = {'String': 'str', 'Character': 'str', 'Float': 'float', 'Integer': 'int', 'Flag': 'bool'}
+DECODE_TYPES = {'str': str, 'float': float, 'int': int, 'bool': bool}
+
+# How each VCF field is decoded: Numbers of R, and Integers with a fixed Number above 1, are kept as the raw string
 def getFields(fields):
-    typeMap = {
-        'String': str,
-        'Float': float,
-        'Integer': int,
-        'Flag': bool
-    }
-    fields = [[x.split('=')[-1] for x in field[:3]] for field in fields]
+    plan = []
     for field in fields:
-        if field[1] == 'R':
-            field[2] = str
-        elif field[2] == 'Integer' and field[1] != 'A' and field[1] != 'G' and int(field[1]) > 1:
-            field[2] = str
+        name, number, vcf_type = [x.split('=')[-1] for x in field[:3]]
+        if number == 'R':
+            decode = 'str'
+        elif vcf_type == 'Integer' and number.isdigit() and int(number) > 1:
+            decode = 'str'
         else:
-            field[2] = typeMap[field[2]]
-    fields = {field[0]:field[2] for field in fields}
-    return fields
+            decode = VCF_TYPES[vcf_type]
+        plan.append({'id': name, 'decode': decode})
+    return plan
 
-# def splitInfor(x, columnType):
-#     res = {k: columnType[k](v) for k, v in [y.split('=') if '=' in y else [y, True] for y in x.split(';')]}
-#     return [res[col] if col in res else None for col in columnType]
+# Header schema registry. A batch shares a handful of Mutect/VarDict header layouts, so every layout is keyed by the sha1
+# of its ##INFO and ##FORMAT lines and its decoding plan is built once per process. The plans are also written as JSON
+# to the schema cache directory (CH_TOOLKIT_SCHEMA_CACHE, empty to turn it off) so later runs only read them back.
+# The cache is best-effort, when it cannot be read or written the plans are only kept in memory.
+# SCHEMA_VERSION is part of the key, bump it whenever getFields or the decoding changes so older plans are not reused
+SCHEMA_VERSION = 2
+SCHEMA_CACHE = os.environ.get('CH_TOOLKIT_SCHEMA_CACHE', os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'ch-toolkit', 'vcf-schemas'))
+schemas = {}
 
-def splitInfor(info_tags, fields):
-    x = [tag.split('=') if '=' in tag else [tag, True] for tag in info_tags.split(';')] # Splits the Tags into Key = Value or Flag = True
-    res = {k: fields[k](v) for k, v in x}                                               # Converts the Value into the correct Type (via Fields Mapping)
-    return [res[field] if field in res else None for field in fields]                   # For each "info_tag/key" (that should be here), assign it the value to the column or else None
+def compile_plan(plan):
+    fields = {field['id']: DECODE_TYPES[field['decode']] for field in plan}
+    tags, tag_offsets = tags_to_buffer(fields)
+    return {'fields': fields, 'tags': tags, 'tag_offsets': tag_offsets}
 
-def combineAndSplit(format, sample, fields):
-    res = {format.split(':')[field]: sample.split(':')[field] for field in range(len(format.split(':')))}   # For each Format Flag, get the dictionary pairing e.g. GT: '0/1'
-    return [fields[field](res[field]) if field in res else None for field in fields]                        # For each "format_tag/key", assign it the value after mapping it to the correct type
+def get_schema(info_lines, format_lines):
+    schema_id = hashlib.sha1(''.join([str(SCHEMA_VERSION)] + info_lines + format_lines).encode()).hexdigest()
+    if schema_id in schemas:
+        return schemas[schema_id]
+    schema_file = os.path.join(SCHEMA_CACHE, f"{schema_id}.json") if SCHEMA_CACHE else None
+    plans = None
+    if schema_file is not None and os.path.exists(schema_file):
+        try:
+            with open(schema_file) as f:
+                plans = json.load(f)
+        except (OSError, ValueError):
+            log.logit(f"WARNING: Could not read the cached VCF schema {schema_file}, rebuilding it", color="yellow")
+    if plans is None:
+        plans = {'info': getFields([line.split(',') for line in info_lines]),
+                 'format': getFields([line.split(',') for line in format_lines])}
+        if schema_file is not None:
+            try:
+                os.makedirs(SCHEMA_CACHE, exist_ok=True)
+                with files.atomic_write(schema_file, 'w') as f:
+                    json.dump(plans, f, indent=1)
+            except OSError:
+                log.logit(f"WARNING: Could not write the VCF schema cache to {SCHEMA_CACHE}, keeping the schema in memory only", color="yellow")
+    schemas[schema_id] = (compile_plan(plans['info']), compile_plan(plans['format']))
+    return schemas[schema_id]
 
-def caller_to_df(input_vcf, batch_number, debug):
-    log.logit(f"Reading in the VCF...")
-    info_fields, format_fields = [], []
-    with gzip.open(input_vcf, 'rt') as f:
-        for line in f:
-            if line.startswith('##INFO'):
-                info_fields.append(line.split(','))
-            elif line.startswith('##FORMAT'):
-                format_fields.append(line.split(','))
-            elif line.startswith('#CHROM'):
-                header = line.strip('\n').split('\t')
+# The INFO and FORMAT/SAMPLE columns are decoded in bulk: every value of a column is joined into a single byte buffer
+# (one record per line), a compiled kernel records where each declared tag's value starts and ends, and the values are
+# then copied into a fixed-width byte matrix that numpy casts to the declared type in one pass.
+@njit(cache=True)
+def find_tag(buffer, start, end, tags, tag_offsets):
+    length = end - start
+    for t in range(len(tag_offsets) - 1):
+        if tag_offsets[t+1] - tag_offsets[t] != length:
+            continue
+        match = True
+        for i in range(length):
+            if buffer[start+i] != tags[tag_offsets[t]+i]:
+                match = False
+                break
+        if match:
+            return t
+    return -1
+
+@njit(cache=True)
+def info_offsets(buffer, tags, tag_offsets, starts, ends):
+    row, token = 0, 0
+    equals = -1
+    for i in range(len(buffer)):
+        c = buffer[i]
+        if c == 61 and equals < 0:                                  # '=' splits the Tag from its Value
+            equals = i
+        elif c == 59 or c == 10:                                    # ';' ends a Tag and '\n' ends the record
+            key_end = equals if equals >= 0 else i
+            t = find_tag(buffer, token, key_end, tags, tag_offsets)
+            if t >= 0:
+                starts[row, t] = equals + 1 if equals >= 0 else i   # A Flag is present, but has no Value
+                ends[row, t] = i
+            token = i + 1
+            equals = -1
+            if c == 10:
+                row += 1
+
+@njit(cache=True)
+def format_offsets(format_buffer, sample_buffer, tags, tag_offsets, starts, ends):
+    n, most = 1, 1
+    for c in format_buffer:                                         # Sized to the longest FORMAT, including Tags not in the header
+        if c == 58:
+            n += 1
+        elif c == 10:
+            most = max(most, n)
+            n = 1
+    order = np.empty(most, dtype=np.int64)
+    f, s = 0, 0
+    for row in range(starts.shape[0]):
+        n, token = 0, f                                             # The FORMAT Tags give the order of the SAMPLE Values
+        while True:
+            c = format_buffer[f]
+            if c == 58 or c == 10:
+                order[n] = find_tag(format_buffer, token, f, tags, tag_offsets)
+                n += 1
+                token = f + 1
+            f += 1
+            if c == 10:
+                break
+        m, token = 0, s
+        while True:
+            c = sample_buffer[s]
+            if c == 58 or c == 10:
+                if m < n and order[m] >= 0:
+                    starts[row, order[m]] = token
+                    ends[row, order[m]] = s
+                m += 1
+                token = s + 1
+            s += 1
+            if c == 10:
                 break
-    f.close()
-    info_fields = getFields(info_fields)
-    format_fields = getFields(format_fields)
+
+@njit(cache=True)
+def gather_values(buffer, starts, ends, width):
+    res = np.zeros((len(starts), width), dtype=np.uint8)
+    for row in range(len(starts)):
+        for i in range(ends[row] - starts[row]):
+            res[row, i] = buffer[starts[row] + i]
+    return res
+
+# Comma separated Integer fields, e.g. AD=12,3, are parsed in the same single pass over the byte buffer straight into
+# n integer columns. Anything that is not an integer, or is missing, is left as NaN
+@njit(cache=True)
+def integer_offsets(buffer, values, present):
+    row, column, value, digits, negative, valid = 0, 0, 0, 0, False, True
+    for i in range(len(buffer)):
+        c = buffer[i]
+        if c == 10 or c == 44:                                      # '\n' ends the record, ',' the value
+            if column < values.shape[1] and digits > 0 and valid:
+                values[row, column] = -value if negative else value
+                present[row, column] = True
+            value, digits, negative, valid = 0, 0, False, True
+            if c == 10:
+                row += 1
+                column = 0
+            else:
+                column += 1
+        elif c >= 48 and c <= 57:
+            value = value * 10 + (c - 48)
+            digits += 1
+        elif c == 45 and digits == 0 and not negative:
+            negative = True
+        else:
+            valid = False
+
+def split_integers(values, columns):
+    values = values.where(values.notnull(), '')
+    buffer = to_buffer(values)
+    res = np.zeros((len(values), len(columns)), dtype=np.int64)
+    present = np.zeros((len(values), len(columns)), dtype=np.bool_)
+    integer_offsets(buffer, res, present)
+    split = {}
+    for i, column in enumerate(columns):
+        if present[:, i].all():
+            split[column] = res[:, i]
+        else:
+            split[column] = np.where(present[:, i], res[:, i], np.nan)
+    return pd.DataFrame(split, index=values.index)
+
+def to_buffer(values):
+    return np.frombuffer(('\n'.join(values) + '\n').encode(), dtype=np.uint8)
+
+def tags_to_buffer(fields):
+    tags = [field.encode() for field in fields]
+    tag_offsets = np.cumsum([0] + [len(tag) for tag in tags]).astype(np.int64)
+    return np.frombuffer(b''.join(tags) or b'\0', dtype=np.uint8), tag_offsets
+
+def typed_values(buffer, starts, ends, field_type):
+    present = starts >= 0
+    if field_type is bool:                                          # Flags are True when present, or else None
+        return pd.Series(np.where(present, True, None), dtype=object)
+    if not present.any():
+        return pd.Series([None] * len(starts), dtype=object)
+    width = max(int((ends - starts)[present].max()), 1)
+    values = gather_values(buffer, np.where(present, starts, 0), np.where(present, ends, 0), width).view(f'S{width}').ravel()
+    if field_type is str:
+        try:
+            values = values.astype(f'U{width}')                     # Fast path for plain ASCII
+        except UnicodeDecodeError:
+            values = np.char.decode(values, 'utf-8')
+        return pd.Series(np.where(present, values, None), dtype=object)
+    values = values[present].astype(np.int64 if field_type is int else np.float64)
+    if present.all():
+        return pd.Series(values)
+    res = np.full(len(starts), np.nan)                              # Missing Integers are stored as NaN, the same as pandas would infer
+    res[present] = values
+    return pd.Series(res)
+
+def decode_info(info, schema):
+    buffer = to_buffer(info)
+    fields, tags, tag_offsets = schema['fields'], schema['tags'], schema['tag_offsets']
+    starts = np.full((len(info), len(fields)), -1, dtype=np.int64)
+    ends = np.full((len(info), len(fields)), -1, dtype=np.int64)
+    info_offsets(buffer, tags, tag_offsets, starts, ends)
+    return pd.DataFrame({field: typed_values(buffer, starts[:, i], ends[:, i], fields[field]) for i, field in enumerate(fields)})
+
+def decode_format(format, sample, schema):
+    format_buffer = to_buffer(format)
+    sample_buffer = to_buffer(sample)
+    fields, tags, tag_offsets = schema['fields'], schema['tags'], schema['tag_offsets']
+    starts = np.full((len(format), len(fields)), -1, dtype=np.int64)
+    ends = np.full((len(format), len(fields)), -1, dtype=np.int64)
+    format_offsets(format_buffer, sample_buffer, tags, tag_offsets, starts, ends)
+    return pd.DataFrame({field: typed_values(sample_buffer, starts[:, i], ends[:, i], fields[field]) for i, field in enumerate(fields)})
+
+def read_caller_header(f):
+    info_fields, format_fields, header = [], [], None
+    for line in f:
+        if line.startswith('##INFO'):
+            info_fields.append(line.strip('\n'))
+        elif line.startswith('##FORMAT'):
+            format_fields.append(line.strip('\n'))
+        elif line.startswith('#CHROM'):
+            header = line.strip('\n').split('\t')
+            break
+    if header is None:
+        raise ValueError("Could not find the #CHROM header line")
     header[-1] = "SAMPLE"
+    info_schema, format_schema = get_schema(info_fields, format_fields)
+    return info_schema, format_schema, header
 
-    res = pd.read_csv(input_vcf,
-                comment='#',
-                compression='gzip',
-                sep='\t',
-                header=None,
-                names=header).rename(columns={'#CHROM':'CHROM'})
-    log.logit(f"Finished reading in the VCF")
+def format_caller_df(res, info_schema, format_schema, batch_number):
+    res = res.rename(columns={'#CHROM':'CHROM'}).reset_index(drop=True)
     log.logit(f"Parsing and formatting INFO and FORMAT columns...")
-    info_field_values = pd.DataFrame(list(res['INFO'].apply(lambda x: splitInfor(x, info_fields) ).values),
-                                    columns=info_fields.keys())
+    info_field_values = decode_info(res['INFO'], info_schema)
     info_field_values.columns = info_field_values.columns.str.lower()
     info_field_values = info_field_values.add_prefix('info_')
-    format_field_values = pd.DataFrame(list(res[['FORMAT', 'SAMPLE']].apply(lambda x: combineAndSplit(*x, format_fields), axis=1).values),
-                                    columns=format_fields.keys())
+    format_field_values = decode_format(res['FORMAT'], res['SAMPLE'], format_schema)
     format_field_values.columns = format_field_values.columns.str.lower()
     format_field_values = format_field_values.add_prefix('format_')
 
@@ -151,9 +466,25 @@ def caller_to_df(input_vcf, batch_number, debug):
     res['key'] = res['CHROM'] + ':' + res['POS'].astype(str) + ':' + res['REF'] + ':' + res['ALT'] #Key needed to get VariantID
     res['FILTER'] = res['FILTER'].str.split(";")
     res['batch'] = batch_number
-    total = len(res)
+    return res
+
+def caller_to_df(input_vcf, batch_number, debug, reader="gzip", region=None, threads=1):
+    log.logit(f"Reading in the VCF...")
+    total, res = 0, None
+    for total, res in caller_to_chunks(input_vcf, batch_number, None, debug, reader, region, threads):
+        pass
+    log.logit(f"Finished reading in the VCF")
     return total, res
 
+# Same as caller_to_df, but only chunk_size records are held in memory at a time
+def caller_to_chunks(input_vcf, batch_number, chunk_size, debug, reader="gzip", region=None, threads=1):
+    log.logit(f"Reading in the VCF in chunks of {chunk_size} records...")
+    with open_vcf(input_vcf, reader, region, threads) as (header, records):
+        info_schema, format_schema, header = read_caller_header(header)
+        for res in read_vcf_records(records, chunk_size, names=header):
+            res = format_caller_df(res, info_schema, format_schema, batch_number)
+            yield len(res), res
+
 def load_simple_header(header_type):
     # TODO
     if header_type == "complex":
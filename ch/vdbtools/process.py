@@ -1,10 +1,11 @@
-import sys
+import sys, shutil, contextlib
 import multiprocessing as mp
 import ch.utils.logger as log
+import ch.utils.database as database
 
-def annotate_fisher_test(pileup_db, caller_db, caller, batch_number, by_chromosome, debug):
+def annotate_fisher_test(pileup_db, caller_db, caller, batch_number, by_chromosome, cache, cache_size, threshold, band, logfac_cache, cores, debug):
     import ch.vdbtools.handlers.callers as callers
-    callers.annotate_fisher_test(pileup_db, caller_db, caller, batch_number, by_chromosome, debug)
+    callers.annotate_fisher_test(pileup_db, caller_db, caller, batch_number, by_chromosome, cache, cache_size, threshold, band, logfac_cache, cores, debug)
 
 def recalculate_bcbio_parameters(vardict_db, low_depth_for_allele_frequency, debug):
     import ch.vdbtools.handlers.callers as callers
@@ -19,7 +20,8 @@ def db_to_chromosome(db, which_db, batch_number, chromosome, cores, debug):
         'mutect'  : caller_to_chromosome,
         'vardict' : caller_to_chromosome,
         'variant' : variant_to_chromosome,
-        'annotation' : annotation_to_chromosome
+        'annotation' : annotation_to_chromosome,
+        'pileup' : pileup_to_chromosome
     }
     function = dispatch[which_db]
     function(db, which_db, batch_number, chromosome, cores, debug)
@@ -34,7 +36,7 @@ def set_options(db, batch_number, chromosome, debug):
         else:
             log.logit(f"Splitting {db} variants into chromosome: {chromosome}", color="green")
             chromosome = [chromosome]
-        base_db = db.replace('.db', '')
+        base_db = db.rstrip('/').replace('.db', '')
     else:
         if chromosome is None:
             log.logit(f"Splitting {db} variants into individual chromosomes for batch: {batch_number}", color="green")
@@ -44,36 +46,56 @@ def set_options(db, batch_number, chromosome, debug):
         else:
             log.logit(f"Splitting {db} variants into chromosome: {chromosome} for batch: {batch_number}", color="green")
             chromosome = [chromosome]
-        base_db = db.replace('.db', '') + f".batch{batch_number}"
+        base_db = db.rstrip('/').replace('.db', '') + f".batch{batch_number}"
     return batch_number, chromosome, base_db
 
+# Instead of every chromosome worker scanning the whole database, it is read once into a temporary dataset partitioned
+# by chromosome (see ch.utils.database), and each worker then only reads its own partition.
+# A single chromosome is already a single range scan, and a dataset is already partitioned, so those are read directly.
+# The temporary dataset is removed once the workers are done, or when the split or any worker fails
+@contextlib.contextmanager
+def split_by_chromosome(db, which_db, batch_number, chromosome, base_db):
+    if len(chromosome) == 1 or database.is_dataset(db):
+        yield db
+        return
+    split = f"{base_db}.split"
+    try:
+        log.logit(f"Splitting {db} into chromosome partitions in a single pass")
+        database.duckdb_to_dataset(db, which_db, split, True, batch_number)
+        yield split
+    finally:
+        shutil.rmtree(split, ignore_errors=True)
+
 def caller_to_chromosome(caller_db, caller, batch_number, chromosome, cores, debug):
     batch_number, chromosome, base_db = set_options(caller_db, batch_number, chromosome, debug)
     import ch.vdbtools.handlers.callers as callers
-    with mp.Pool(cores) as p:
-        p.starmap(callers.caller_to_chromosome, [(caller_db, caller, batch_number, chrom, base_db, debug) for chrom in chromosome])
-    #callers.caller_to_chromosome(caller_db, caller, batch_number, chromosome, base_db, debug)
+    with split_by_chromosome(caller_db, caller, batch_number, chromosome, base_db) as source:
+        with database.worker_pool(cores) as p:
+            p.starmap(callers.caller_to_chromosome, [(source, caller, batch_number, chrom, base_db, debug) for chrom in chromosome])
 
 def variant_to_chromosome(variant_db, variant, batch_number, chromosome, cores, debug):
     batch_number, chromosome, base_db = set_options(variant_db, batch_number, chromosome, debug)
     import ch.vdbtools.handlers.variants as variants
-    with mp.Pool(cores) as p:
-        p.starmap(variants.variant_to_chromosome, [(variant_db, variant, chrom, base_db, debug) for chrom in chromosome])
-    #variants.variant_to_chromosome(variant_db, variant, chromosome, base_db, debug)
+    with split_by_chromosome(variant_db, variant, None, chromosome, base_db) as source:
+        with database.worker_pool(cores) as p:
+            p.starmap(variants.variant_to_chromosome, [(source, variant, chrom, base_db, debug) for chrom in chromosome])
 
 def annotation_to_chromosome(annotation_db, annotation, batch_number, chromosome, cores, debug):
     batch_number, chromosome, base_db = set_options(annotation_db, batch_number, chromosome, debug)
     import ch.vdbtools.handlers.annotations as annotations
-    with mp.Pool(cores) as p:
-        p.starmap(annotations.annotation_to_chromosome, [(annotation_db, annotation, chrom, base_db, debug) for chrom in chromosome])
-    #annotations.annotation_to_chromosome(annotation_db, annotation, chromosome, base_db, debug)
+    with split_by_chromosome(annotation_db, annotation, None, chromosome, base_db) as source:
+        with database.worker_pool(cores) as p:
+            p.starmap(annotations.annotation_to_chromosome, [(source, annotation, chrom, base_db, debug) for chrom in chromosome])
 
 def pileup_to_chromosome(pileup_db, pileup, batch_number, chromosome, cores, debug):
     batch_number, chromosome, base_db = set_options(pileup_db, batch_number, chromosome, debug)
     import ch.vdbtools.handlers.variants as variants
-    with mp.Pool(cores) as p:
-        p.starmap(variants.pileup_to_chromosome, [(pileup_db, pileup, chrom, base_db, debug) for chrom in chromosome])
-    #variants.pileup_to_chromosome(pileup_db, pileup, chromosome, base_db, debug)
+    with split_by_chromosome(pileup_db, pileup, None, chromosome, base_db) as source:
+        with database.worker_pool(cores) as p:
+            p.starmap(variants.pileup_to_chromosome, [(source, pileup, chrom, base_db, debug) for chrom in chromosome])
+
+def db_to_dataset(db, which_db, dataset, debug, clobber):
+    database.duckdb_to_dataset(db, which_db, dataset, clobber)
 
 def chromosome_to_caller(chr_path, caller_db, caller, debug):
     import ch.vdbtools.handlers.callers as callers
@@ -84,6 +106,6 @@ def ch_variants_only(caller_db, caller, annotation_db, batch_number, chromosome,
     import ch.vdbtools.analysis.ch as ch
     #for chrom in chromosome:
     #    ch.ch_variants_only(mutect_db, vardict_db, annotation_db, chrom, debug)
-    with mp.Pool(cores) as p:
+    with database.worker_pool(cores) as p:
         p.starmap(ch.ch_variants_only, [(caller_db, base_db, caller, annotation_db, chrom, debug) for chrom in chromosome])
     ch.merge_ch_variants(base_db, caller)
\ No newline at end of file
@@ -0,0 +1,5 @@
+import numba
+
+# The fisher tests run the parallel kernels in the pytest process itself, and other tests fork worker pools from it
+# afterwards, which the TBB threading layer does not survive at exit
+numba.config.THREADING_LAYER = 'workqueue'
@@ -0,0 +1,65 @@
+import pytest
+
+import ch.utils.database as db
+import ch.vdbtools.process as process
+import ch.vdbtools.handlers.variants as variants
+
+PILEUP = [
+    ('chr1', 100, 'A', 'T', 1),
+    ('chr1', 200, 'C', 'CAT', 1),
+    ('chr2', 300, 'G', 'A', 1),
+    ('chrX', 400, 'T', 'C', 2)
+]
+
+def make_pileup_db(tmp_path):
+    pileup_db = str(tmp_path / "pileup.db")
+    connection = db.duckdb_connect_rw(pileup_db, True)
+    variants.ensure_pileup_table(connection)
+    for (chrom, pos, ref, alt, batch) in PILEUP:
+        connection.execute(f"INSERT INTO pileup VALUES (vkey('{chrom}', {pos}, '{ref}', '{alt}'), 10, 1, {batch}, {pos})")
+    connection.close()
+    return pileup_db
+
+def chromosome_rows(tmp_path, chrom):
+    connection = db.duckdb_connect_ro(str(tmp_path / f"pileup.{chrom}.db"))
+    rows = connection.execute("SELECT variant_id FROM pileup ORDER BY variant_id").fetchall()
+    connection.close()
+    return [variant_id for (variant_id,) in rows]
+
+def test_split_pileup_db(tmp_path):
+    pileup_db = make_pileup_db(tmp_path)
+    process.db_to_chromosome(pileup_db, 'pileup', None, None, 1, False)
+    assert chromosome_rows(tmp_path, 'chr1') == [100, 200]
+    assert chromosome_rows(tmp_path, 'chr2') == [300]
+    assert chromosome_rows(tmp_path, 'chrX') == [400]
+    assert chromosome_rows(tmp_path, 'chr3') == []
+    assert not (tmp_path / "pileup.split").exists()
+
+def test_split_pileup_db_single_chromosome(tmp_path):
+    pileup_db = make_pileup_db(tmp_path)
+    process.db_to_chromosome(pileup_db, 'pileup', None, 'chr1', 1, False)
+    assert chromosome_rows(tmp_path, 'chr1') == [100, 200]
+    assert not (tmp_path / "pileup.chr2.db").exists()
+
+def fail_chromosome(pileup_db, pileup, chrom, base_db, debug):
+    raise RuntimeError(f"failed {chrom}")
+
+def test_split_removed_when_a_worker_fails(tmp_path, monkeypatch):
+    pileup_db = make_pileup_db(tmp_path)
+    monkeypatch.setattr(variants, 'pileup_to_chromosome', fail_chromosome)
+    with pytest.raises(RuntimeError):
+        process.db_to_chromosome(pileup_db, 'pileup', None, None, 1, False)
+    assert not (tmp_path / "pileup.split").exists()
+
+def test_chrom_filter_outside_the_listed_contigs():
+    connection = db.duckdb_connect(":memory:")
+    connection.execute("CREATE TABLE t AS SELECT key, vkey_of(key) AS vkey FROM (VALUES ('chr1:5:A:T'), ('chrUn_a:5:A:T'), ('chr9_b_alt:5:A:T')) v(key)")
+    rows = lambda chrom: [key for (key,) in connection.execute(f"SELECT key FROM t WHERE {db.chrom_filter(chrom)}").fetchall()]
+    assert rows('chr1') == ['chr1:5:A:T']
+    assert rows('chrUn_a') == ['chrUn_a:5:A:T']
+    assert connection.execute("SELECT count(*) FROM t WHERE vkey_in_chrom(vkey, 'chrUn_a')").fetchone()[0] == 0
+
+def test_split_pileup_db_rejects_unlisted_contig(tmp_path):
+    pileup_db = make_pileup_db(tmp_path)
+    with pytest.raises(ValueError):
+        process.db_to_chromosome(pileup_db, 'pileup', None, 'chrUn_a', 1, False)
@@ -0,0 +1,32 @@
+import duckdb
+import numpy as np
+import pandas as pd
+
+import ch.utils.fisher_exact_test as fisher_test
+
+def fisher_connection():
+    connection = duckdb.connect()
+    return fisher_test.create_fisher_function(connection)
+
+def test_fisher_function_matches_pvalue_df():
+    df = pd.DataFrame({
+        'PoN_RefDepth'   : [100, 2000, 50, 30],
+        'PoN_AltDepth'   : [5, 1, 0, 10],
+        'format_ref_fwd' : [5, 40, 10, 3],
+        'format_ref_rev' : [5, 40, 10, 3],
+        'format_alt_fwd' : [3, 10, 2, 1],
+        'format_alt_rev' : [2, 10, 2, 0]
+    })
+    expected = fisher_test.pvalue_df(df.copy())['pvalue'].to_numpy()
+    sql = "SELECT fisher_exact_test(PoN_RefDepth, PoN_AltDepth, format_ref_fwd + format_ref_rev, format_alt_fwd + format_alt_rev) AS pvalue FROM df"
+    pvalues = fisher_connection().execute(sql).df()['pvalue'].to_numpy()
+    assert np.array_equal(pvalues, expected)
+
+def test_fisher_function_null_arguments():
+    connection = fisher_connection()
+    rows = connection.execute("""
+        SELECT fisher_exact_test(a, b, c, d)
+        FROM (VALUES (100, 5, 10, NULL), (100, NULL, 10, 5), (NULL, NULL, NULL, NULL), (100, 5, 10, 5)) t(a, b, c, d)
+    """).fetchall()
+    assert [row[0] for row in rows[:3]] == [None, None, None]
+    assert rows[3][0] is not None and 0 <= rows[3][0] <= 1
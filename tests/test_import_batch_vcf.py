@@ -0,0 +1,74 @@
+import gzip
+import duckdb
+
+import ch.vdbtools.handlers.callers as callers
+
+HEADER = [
+    '##fileformat=VCFv4.2',
+    '##FILTER=<ID=PASS,Description="All filters passed">',
+    '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">',
+    '##FORMAT=<ID=AF,Number=A,Type=Float,Description="Allele fractions">',
+    '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth">',
+    '##FORMAT=<ID=F1R2,Number=R,Type=Integer,Description="Count of reads">',
+    '##FORMAT=<ID=F2R1,Number=R,Type=Integer,Description="Count of reads">',
+    '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+    '##FORMAT=<ID=SB,Number=4,Type=Integer,Description="Per-sample component statistics">',
+    '##INFO=<ID=AS_FilterStatus,Number=A,Type=String,Description="Filter status">',
+    '##INFO=<ID=AS_SB_TABLE,Number=1,Type=String,Description="Allele-specific forward/reverse read counts">',
+    '##INFO=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth">',
+    '##INFO=<ID=ECNT,Number=1,Type=Integer,Description="Number of events">',
+    '##INFO=<ID=MBQ,Number=R,Type=Integer,Description="median base quality">',
+    '##INFO=<ID=MFRL,Number=R,Type=Integer,Description="median fragment length">',
+    '##INFO=<ID=MMQ,Number=R,Type=Integer,Description="median mapping quality">',
+    '##INFO=<ID=MPOS,Number=A,Type=Integer,Description="median distance">',
+    '##INFO=<ID=POPAF,Number=A,Type=Float,Description="negative log 10 population allele frequencies">',
+    '##INFO=<ID=ROQ,Number=1,Type=Float,Description="Phred-scaled qualities">',
+    '##INFO=<ID=RPA,Number=R,Type=Integer,Description="Number of times tandem repeat unit is repeated">',
+    '##INFO=<ID=RU,Number=1,Type=String,Description="Tandem repeat unit (bases)">',
+    '##INFO=<ID=STR,Number=0,Type=Flag,Description="Variant is a short tandem repeat">',
+    '##INFO=<ID=STRQ,Number=1,Type=Integer,Description="Phred-scaled quality">',
+    '##INFO=<ID=TLOD,Number=A,Type=Float,Description="Log 10 likelihood ratio score">',
+    '##INFO=<ID=PON_2AT2_PERCENT,Number=0,Type=Flag,Description="PoN">',
+    '##INFO=<ID=PON_NAT2_PERCENT,Number=1,Type=Integer,Description="PoN">',
+    '##INFO=<ID=PON_MAX_VAF,Number=1,Type=Float,Description="PoN">',
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE_T'
+]
+RECORDS = [
+    'chr1\t10008\t.\tA\tATTCA\t.\tgermline\tAS_FilterStatus=SITE;AS_SB_TABLE=124,125|0,1;DP=250;ECNT=4;MBQ=28,27;MFRL=152,262;MMQ=60,21;MPOS=2;POPAF=0.18;ROQ=70;RPA=7,4;STRQ=68;TLOD=22.17;PON_NAT2_PERCENT=3;PON_MAX_VAF=0.6768\tGT:AD:AF:DP:F1R2:F2R1:SB\t0/1:249,1:0.004:250:124,0:125,1:124,125,0,1',
+    'chr1\t10009\t.\tT\tG\t.\tstrand_bias;weak_evidence\tAS_FilterStatus=strand_bias|strand_bias;AS_SB_TABLE=25,26|5,6;DP=62;ECNT=5;MBQ=33,36;MFRL=197,255;MMQ=60,38;MPOS=38;POPAF=6.81;ROQ=64;STRQ=5;TLOD=48.02;PON_NAT2_PERCENT=2;PON_MAX_VAF=0.8827\tGT:AD:AF:DP:F1R2:F2R1:SB\t0/1:51,11:0.175:62:25,5:26,6:25,26,5,6'
+]
+
+def write_vcf(path, records):
+    with gzip.open(path, 'wt') as f:
+        f.write('\n'.join(HEADER + records) + '\n')
+    return str(path)
+
+def caller_rows(db_file):
+    connection = duckdb.connect(db_file, read_only=True)
+    rows = connection.execute("SELECT count(*), count(DISTINCT key) FROM mutect").fetchone()
+    connection.close()
+    return rows
+
+def test_rerun_skips_imported_vcfs(tmp_path):
+    vcfs = tmp_path / "vcfs"
+    vcfs.mkdir()
+    good = write_vcf(vcfs / "mutect.S1.vcf.gz", RECORDS)
+    bad = vcfs / "mutect.S2.vcf.gz"
+    bad.write_text("not a vcf")
+    db_path = str(tmp_path / "db")
+
+    summary = callers.insert_caller_files([good, str(bad)], db_path, "mutect", 1, 1000, "gzip", None, 1, False, False)
+    assert summary['error'].notnull().tolist() == [False, True]
+    assert caller_rows(f"{db_path}/mutect.S1.db") == (2, 2)
+    assert not (tmp_path / "db" / "mutect.S2.db").exists()
+
+    write_vcf(bad, RECORDS[:1])
+    summary = callers.insert_caller_files([good, str(bad)], db_path, "mutect", 1, 1000, "gzip", None, 1, False, False)
+    assert summary['error'].isnull().all()
+    assert summary['skipped'].tolist() == [True, False]
+    assert caller_rows(f"{db_path}/mutect.S1.db") == (2, 2)
+    assert caller_rows(f"{db_path}/mutect.S2.db") == (1, 1)
+
+    summary = callers.insert_caller_files([good], db_path, "mutect", 1, 1000, "gzip", None, 1, False, True)
+    assert summary['skipped'].tolist() == [False]
+    assert caller_rows(f"{db_path}/mutect.S1.db") == (2, 2)
@@ -0,0 +1,33 @@
+import os
+
+import ch.vdbtools.handlers.vcf as vcf
+
+INFO = ['##INFO=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth">',
+        '##INFO=<ID=MBQ,Number=R,Type=Integer,Description="median base quality">']
+FORMAT = ['##FORMAT=<ID=AF,Number=A,Type=Float,Description="Allele fractions">']
+
+def schema_fields(monkeypatch, cache):
+    monkeypatch.setattr(vcf, 'SCHEMA_CACHE', cache)
+    monkeypatch.setattr(vcf, 'schemas', {})
+    info, format = vcf.get_schema(INFO, FORMAT)
+    return info['fields'], format['fields']
+
+def test_schema_cache_round_trip(tmp_path, monkeypatch):
+    cache = str(tmp_path / "schemas")
+    fields = schema_fields(monkeypatch, cache)
+    assert fields == ({'DP': int, 'MBQ': str}, {'AF': float})
+    assert len(os.listdir(cache)) == 1
+    assert schema_fields(monkeypatch, cache) == fields
+
+def test_schema_cache_version_is_part_of_the_key(tmp_path, monkeypatch):
+    cache = str(tmp_path / "schemas")
+    schema_fields(monkeypatch, cache)
+    monkeypatch.setattr(vcf, 'SCHEMA_VERSION', vcf.SCHEMA_VERSION + 1)
+    schema_fields(monkeypatch, cache)
+    assert len(os.listdir(cache)) == 2
+
+def test_schema_cache_unwritable_or_off(tmp_path, monkeypatch):
+    (tmp_path / "file").write_text("")
+    assert schema_fields(monkeypatch, str(tmp_path / "file" / "schemas")) == ({'DP': int, 'MBQ': str}, {'AF': float})
+    assert schema_fields(monkeypatch, "") == ({'DP': int, 'MBQ': str}, {'AF': float})
+    assert os.listdir(tmp_path) == ["file"]